@@ -0,0 +1,267 @@
+"""
+The asyncio serving mode of the service: an aiohttp webhook, and bots which await their Telegram calls (AsyncTeleBot)
+instead of holding an OS thread for each of them. Every message is handled in a task of its own, the image operations
+run on the image executor (or a CPU thread pool) and the blocking boto3 calls on an I/O thread pool of their own.
+
+Set TELEGRAM_API_URL to talk to another Telegram Bot API server, e.g. a local fake one for testing.
+"""
+from aiohttp import web
+from loguru import logger
+from telebot import asyncio_helper
+import asyncio
+import json
+import time
+import os
+from flask_app import (TELEGRAM_APP_URL, MESSAGE_QUEUE_MAX_SIZE, MESSAGE_QUEUE_HIGH_WATERMARK, MESSAGE_QUEUE_RETRY_AFTER,
+                       RESULT_POLLERS_MAX, update_keys)
+import flask_app
+from process_results import RECEIVE_BATCH_SIZE, RECEIVE_WAIT_SECONDS
+from process_messages import ShardedMessageQueue
+from queue_backends import SQLiteSeenSet
+from async_bot import AsyncBotFactory, run_blocking
+from aws_clients import aws_clients
+
+# The base URL of the Telegram Bot API server (default - Telegram's own)
+TELEGRAM_API_URL     = os.getenv('TELEGRAM_API_URL', None)
+# The maximum number of concurrent connections to the Telegram Bot API server
+TELEGRAM_CONNECTIONS = int(os.getenv('TELEGRAM_CONNECTIONS', '100'))
+REGISTER_WEBHOOK     = os.getenv('REGISTER_WEBHOOK', 'true').lower() == 'true'
+POLL_RESULTS         = os.getenv('POLL_RESULTS', 'true').lower() == 'true'
+ASYNC_PORT           = int(os.getenv('ASYNC_PORT', '8443'))
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = f"{TELEGRAM_API_URL.rstrip('/')}/bot{{0}}/{{1}}"
+    asyncio_helper.FILE_URL = f"{TELEGRAM_API_URL.rstrip('/')}/file/bot{{0}}/{{1}}"
+asyncio_helper.REQUEST_LIMIT = TELEGRAM_CONNECTIONS
+
+class ChatDispatcher:
+    """
+    Handles every message in a task of its own, while the messages of a chat are handled one at a time, in order.
+
+    The number of messages in flight is bounded like the message queue of the threaded mode: from the high watermark on
+    plain text messages are dropped, and at max_in_flight every message is rejected so the sender retries it later.
+    """
+    def __init__(self, bot_factory, max_in_flight=0, high_watermark=None):
+        self.bot_factory = bot_factory
+        self.max_in_flight = max_in_flight
+        self.high_watermark = high_watermark or int(max_in_flight * 0.8)
+        # chat id -> [the chat's lock, the number of the chat's messages in flight]
+        self._chats = {}
+        self._tasks = set()
+        self.in_flight = 0
+        self.handled = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def dispatch(self, msg) -> str:
+        """
+        Starts handling the message in the background unless too many messages are in flight.
+        :return: ShardedMessageQueue's QUEUED, DROPPED or REJECTED
+        """
+        if self.max_in_flight:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return ShardedMessageQueue.REJECTED
+
+            if self.in_flight >= self.high_watermark and "photo" not in msg and "reply_to_message" not in msg:
+                self.dropped += 1
+                return ShardedMessageQueue.DROPPED
+
+        self.in_flight += 1
+        # The time it was received at, e.g. a media group's window is counted from its photos' arrival
+        task = asyncio.create_task(self.handle(dict(msg, received_at=time.time())))
+        # The loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return ShardedMessageQueue.QUEUED
+
+    async def handle(self, msg) -> None:
+        started = time.monotonic()
+        chat_id = (msg.get("chat") or {}).get("id", 0)
+        chat = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        chat[1] += 1
+
+        try:
+            async with chat[0]:
+                bot = self.bot_factory.get_bot(msg)
+                await bot.handle_message(msg)
+                logger.debug(f"Message processed: {msg}")
+        except Exception as e:
+            logger.exception(f"Error while handling a message: {e}")
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[chat_id]
+
+            seconds = time.monotonic() - started
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.handled += 1
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "messages": self.in_flight,
+            "chats": len(self._chats),
+            "max_size": self.max_in_flight,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "avg_handle_seconds": self.total_seconds / self.handled if self.handled else 0.0,
+            "max_handle_seconds": self.max_seconds,
+        }
+
+async def poll_results(dispatcher):
+    """
+    Polls the results queue of the object detection service in batches, handling every result in a task of its own
+    and deleting each batch's handled results together. Up to RESULT_POLLERS_MAX batches are handled at a time.
+    """
+    sqs_client = aws_clients.get('sqs', os.environ['AWS_DEFAULT_REGION'])
+    queue_name = os.environ['SQS_QUEUE_RESULTS']
+    batches = asyncio.Semaphore(RESULT_POLLERS_MAX)
+
+    async def handle_result(message):
+        try:
+            msg = json.loads(message['Body']).get("message")
+            await dispatcher.bot_factory.get_bot(msg).handle_message(msg)
+            return message['ReceiptHandle']
+        except Exception as e:
+            logger.exception(f"Error while handling result {message.get('MessageId')}: {e}")
+            return None
+
+    async def handle_batch(messages):
+        try:
+            receipt_handles = [receipt_handle for receipt_handle in await asyncio.gather(*map(handle_result, messages)) if receipt_handle]
+
+            if receipt_handles:
+                # Delete the handled results from the queue as their jobs are considered as DONE
+                entries = [{"Id": str(index), "ReceiptHandle": receipt_handle} for index, receipt_handle in enumerate(receipt_handles)]
+                response = await run_blocking(sqs_client.delete_message_batch, QueueUrl=queue_name, Entries=entries)
+
+                for failed in response.get('Failed', []):
+                    logger.error(f"Was unable to delete a handled result from the queue: {failed}")
+        except Exception as e:
+            logger.exception(f"Error while deleting the handled results: {e}")
+        finally:
+            batches.release()
+
+    tasks = set()
+    while True:
+        try:
+            await batches.acquire()
+
+            try:
+                response = await run_blocking(sqs_client.receive_message, QueueUrl=queue_name, MaxNumberOfMessages=RECEIVE_BATCH_SIZE,
+                                              WaitTimeSeconds=RECEIVE_WAIT_SECONDS)
+            except BaseException:
+                batches.release()
+                raise
+
+            if not response.get('Messages'):
+                batches.release()
+                continue
+
+            task = asyncio.create_task(handle_batch(response['Messages']))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Error while polling the results queue: {e}")
+            await asyncio.sleep(1)
+
+async def index(request):
+    return web.Response(text='Ok')
+
+async def webhook(request):
+    return await enqueue(request)
+
+async def load_test(request):
+    # A load test sends the same update over and over, which must all be handled rather than dropped as re-deliveries
+    return await enqueue(request, dedup=False)
+
+async def health(request):
+    return web.json_response({"status": "healthy", "message": "Service is up and running!"})
+
+async def ready(request):
+    return web.json_response({"status": "ready", "message": "Service is ready!"})
+
+async def queues(request):
+    stats = dict(request.app["dispatcher"].stats(), duplicates=request.app["seen_updates"].hits, aws=aws_clients.stats())
+    return web.json_response(stats)
+
+async def enqueue(request, dedup=True):
+    """
+    Dispatches the update's message, unless it's a re-delivery of an update already seen
+    :param dedup: Check whether the update was already seen
+    """
+    req = await request.json()
+    if "message" in req:
+        msg = req['message']
+    elif "edited_message" in req:
+        msg = req['edited_message']
+    else:
+        return web.Response(text='No message', status=400)
+
+    keys = update_keys(req, msg) if dedup else []
+
+    # Every key is recorded, so a re-delivery is caught by whichever key it repeats
+    seen_updates = request.app["seen_updates"]
+    if not all([seen_updates.add(key) for key in keys]):
+        return web.Response(text='Duplicate')
+
+    status = request.app["dispatcher"].dispatch(msg)
+
+    if status == ShardedMessageQueue.REJECTED:
+        # Not handled, so the update must not count as seen when Telegram retries it
+        for key in keys:
+            seen_updates.pop(key)
+
+        return web.Response(text='Too busy, please retry', status=503, headers={'Retry-After': MESSAGE_QUEUE_RETRY_AFTER})
+
+    if status == ShardedMessageQueue.DROPPED:
+        return web.Response(text='Dropped')
+
+    return web.Response(text='Ok')
+
+async def on_startup(app):
+    bot_factory = AsyncBotFactory(flask_app.TELEGRAM_TOKEN)
+    app["dispatcher"] = ChatDispatcher(bot_factory, MESSAGE_QUEUE_MAX_SIZE, MESSAGE_QUEUE_HIGH_WATERMARK)
+    # Shared with the other processes using the same database when MESSAGE_QUEUE_BACKEND is sqlite
+    app["seen_updates"] = flask_app.create_seen_updates()
+
+    if REGISTER_WEBHOOK:
+        await bot_factory.register_webhook(flask_app.TELEGRAM_TOKEN, TELEGRAM_APP_URL, flask_app.DOMAIN_CERTIFICATE)
+
+    if POLL_RESULTS:
+        app["results_poller"] = asyncio.create_task(poll_results(app["dispatcher"]))
+
+async def on_cleanup(app):
+    if "results_poller" in app:
+        app["results_poller"].cancel()
+
+    await app["dispatcher"].bot_factory.tgbot.close_session()
+
+    if isinstance(app["seen_updates"], SQLiteSeenSet):
+        app["seen_updates"].close()
+
+def create_app():
+    flask_app.init_app()
+
+    app = web.Application()
+    app.router.add_get('/', index)
+    app.router.add_get('/health', health)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/queues', queues)
+    app.router.add_post(f'/{flask_app.TELEGRAM_TOKEN}/', webhook)
+    app.router.add_post('/loadTest/', load_test)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    return app
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host='0.0.0.0', port=ASYNC_PORT)
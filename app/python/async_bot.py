@@ -0,0 +1,298 @@
+import telebot
+from loguru import logger
+import os
+import io
+import asyncio
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import InputFile, InputMediaPhoto
+from img_executor import InlineExecutor, get_image_executor, run_image_job, run_concat_job
+from bot_utils import upload_image_to_s3, download_image_from_s3, parse_result, send_to_sqs, get_from_db
+from bot import (BotFactory, Bot, QuoteBot, ImageProcessingBot, ObjectDetectionBot, WELCOME_TEXT, PREVIEW_CAPTION, IMAGES_BUCKET,
+                 IMAGES_PREFIX, QUEUE_IDENTIFY, PREVIEW_PIXELS)
+
+# The threads the image operations run on when the image executor runs them inline (default - one per CPU)
+ASYNC_CPU_THREADS = int(os.getenv('ASYNC_CPU_THREADS', '0')) or os.cpu_count()
+# The threads the blocking boto3 calls run on, including the results queue's long polls which hold one for up to 20 seconds
+ASYNC_IO_THREADS  = int(os.getenv('ASYNC_IO_THREADS', '32'))
+
+# Separate pools, so neither kind of work waits for threads held by the other
+cpu_executor = ThreadPoolExecutor(max_workers=ASYNC_CPU_THREADS, thread_name_prefix="AsyncCPU")
+io_executor  = ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix="AsyncIO")
+
+async def run_cpu(fn, *args, **kwargs):
+    """
+    Runs CPU bound work off the event loop: on the image executor, or on cpu_executor when the image executor runs
+    its jobs inline (on the calling thread, which here would be the event loop's).
+    """
+    executor = get_image_executor()
+
+    if isinstance(executor, InlineExecutor):
+        executor = cpu_executor
+
+    return await asyncio.wrap_future(executor.submit(fn, *args, **kwargs))
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Runs a blocking call (e.g. boto3's S3, SQS and DynamoDB calls) on io_executor
+    """
+    return await asyncio.get_running_loop().run_in_executor(io_executor, functools.partial(fn, *args, **kwargs))
+
+class AsyncBotFactory(BotFactory):
+    """
+    The asyncio counterpart of BotFactory, its bots make all their Telegram calls with AsyncTeleBot, without blocking the event loop.
+    """
+    def __init__(self, token):
+        self.tgbot = AsyncTeleBot(token)
+
+        self.bot = AsyncBot(self.tgbot)
+        self.quote_bot = AsyncQuoteBot(self.tgbot)
+        self.image_processing_bot = AsyncImageProcessingBot(self.tgbot)
+        self.object_detection_bot = AsyncObjectDetectionBot(self.tgbot)
+
+    async def register_webhook(self, token, telegram_chat_url, domain_certificate):
+        # Remove any existing webhooks configured in Telegram servers
+        await self.tgbot.remove_webhook()
+        await asyncio.sleep(0.5)
+
+        # Set the webhook URL
+        await self.tgbot.set_webhook(url=f'{telegram_chat_url}:8443/{token}/', certificate=domain_certificate, timeout=90)
+
+        logger.info(f'Telegram Bot information\n\n{await self.tgbot.get_me()}')
+
+class AsyncBot(Bot):
+    """
+    The asyncio counterpart of Bot, the basic 'echo' bot
+    """
+    async def handle_exception(self, exception, chat_id):
+        if chat_id is None:
+            logger.exception(f"Exception occurred without an active chat context.\n{exception}")
+            return
+
+        logger.exception(f"Exception in chat {chat_id}:\n{exception}")
+        try:
+            await self.send_message(chat_id, f"An error has occurred:\n{exception}\nPlease try again.")
+        except Exception as e:
+            logger.exception(f"Was unable to report the exception to chat {chat_id}.\n{e}")
+
+    async def send_welcome(self, chat_id):
+        await self.send_message(chat_id, WELCOME_TEXT, parse_mode="Markdown")
+
+    async def send_text(self, chat_id, text):
+        await self.send_message(chat_id, text)
+
+    async def handle_message(self, msg):
+        """Bot Main message handler"""
+        logger.info(f'Regular Bot - incoming message: {msg}')
+        chat_id = msg['chat']['id']
+
+        if "text" in msg:
+            text = msg["text"].lower()
+            if any(substring in text for substring in ["start", "help", "hello"]):
+                await self.send_welcome(chat_id)
+            else:
+                await self.send_text(chat_id, f'Your original message: {msg["text"]}')
+        else:
+            await self.handle_exception(Exception('None user message received'), chat_id)
+
+class AsyncQuoteBot(AsyncBot, QuoteBot):
+    """
+    The asyncio counterpart of QuoteBot
+    """
+    async def send_text_with_quote(self, chat_id, text, quoted_msg_id):
+        await self.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
+
+    async def handle_message(self, msg):
+        """Quote Bot message handler"""
+        logger.info(f'Quote Bot - incoming message: {msg}')
+        chat_id = msg['chat']['id']
+
+        if "text" in msg:
+            if msg["text"] != 'Please don\'t quote me':
+                await self.send_text_with_quote(chat_id, msg["text"], quoted_msg_id=msg["message_id"])
+        else:
+            await self.handle_exception(Exception('None user message received'), chat_id)
+
+class AsyncImageProcessingBot(AsyncBot, ImageProcessingBot):
+    """
+    The asyncio counterpart of ImageProcessingBot. Everything but the I/O is ImageProcessingBot's: the request parsing,
+    the photo selection, the preview planning and the caches. The image operations themselves run on run_cpu.
+    """
+    async def send_preview(self, chat_id, msg, preview):
+        try:
+            preview_size, operations = preview
+            image = await self.download_user_photo(msg, preview_size)
+            data = await run_cpu(run_image_job, image, operations, max_pixels=PREVIEW_PIXELS)
+
+            return await self.send_photo(chat_id, InputFile(io.BytesIO(data)), caption=PREVIEW_CAPTION)
+        except Exception as e:
+            # The full result follows anyway, so a failed preview is only logged
+            logger.warning(f"Was unable to send a preview.\n{e}")
+            return None
+
+    async def send_result(self, chat_id, result, preview_msg=None):
+        photo = self.result_photo(result)
+
+        if preview_msg:
+            try:
+                return await self.edit_message_media(media=InputMediaPhoto(photo), chat_id=chat_id, message_id=preview_msg.message_id)
+            except Exception as e:
+                logger.warning(f"Was unable to replace the preview, sending the result separately.\n{e}")
+                # The failed upload may have consumed it
+                photo = self.result_photo(result)
+
+        if isinstance(result, dict):
+            await self.send_cached_result(chat_id, result)
+            return None
+
+        return await self.send_photo(chat_id, photo)
+
+    async def download_user_photo(self, msg, photo=None):
+        photo = photo or msg['photo'][-1]
+
+        # The photo cache is in memory or on a local disk, which is quicker than a hop to another thread
+        data = self.cached_photo(photo)
+        if data:
+            return data
+
+        file_info = await self.get_file(photo['file_id'])
+        data = await self.download_file(file_info.file_path)
+        self.cache_photo(photo, data, file_info.file_path)
+
+        return data
+
+    async def handle_photo(self, chat_id, img, caption=""):
+        try:
+            photo = self.photo_file(img)
+        except FileNotFoundError as e:
+            await self.handle_exception(e, chat_id)
+            return None
+
+        if not caption:
+            return await self.send_photo(chat_id, photo)
+
+        return await self.send_photo(chat_id, photo, caption=caption)
+
+    async def send_cached_result(self, chat_id, cached):
+        try:
+            await self.send_photo(chat_id, cached["file_id"])
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            logger.warning(f"Cached file_id was rejected, uploading the cached result instead.\n{e}")
+            await self.send_photo(chat_id, InputFile(io.BytesIO(cached["data"])))
+
+    async def handle_message(self, msg):
+        """Image Bot message handler"""
+        logger.info(f"Image Processing Bot - incoming message {msg}")
+        chat_id = msg['chat']['id']
+
+        try:
+            request = self.parse_request(msg)
+        except (ValueError, RuntimeError) as e:
+            await self.handle_exception(e, chat_id)
+            return
+
+        operations = request["operations"]
+
+        # A photo which was already processed the same way is answered by re-sending the previous result
+        cached = self.cached_result(msg, operations)
+        if cached:
+            try:
+                await self.send_cached_result(chat_id, cached)
+                return
+            except Exception as e:
+                logger.warning(f"Was unable to send the cached result, processing the image again.\n{e}")
+
+        # A slow operation on a large photo first gets a quick low resolution preview
+        preview = self.plan_preview(msg, operations, request["photo_size"], request["max_pixels"])
+        preview_msg = await self.send_preview(chat_id, msg, preview) if preview else None
+
+        try:
+            image = await self.download_user_photo(msg, request["photo_size"])
+            if not image:
+                raise Exception("Was unable to download image from Bot.")
+        except Exception as e:
+            await self.handle_exception(e, chat_id)
+            return
+
+        if request["concat"]:
+            # The collector completes the groups on its scheduler thread, which hands them back to the event loop
+            loop = asyncio.get_running_loop()
+
+            def on_complete(images, **options):
+                asyncio.run_coroutine_threadsafe(self.concat_media_group(chat_id, images, **options), loop)
+
+            if self.add_to_media_group(msg, request, image, on_complete):
+                # Let the user that something is happening
+                await self.send_text(chat_id, "Processing, please wait...")
+            return
+
+        if not preview_msg:
+            # Let the user that something is happening
+            await self.send_text(chat_id, "Processing, please wait...")
+
+        try:
+            if preview_msg:
+                # The same result may have been sent (and cached) while the preview was being made
+                cached = self.cached_result(msg, operations)
+                if cached:
+                    await self.send_result(chat_id, cached, preview_msg)
+                    return
+
+            result = await run_cpu(run_image_job, image, operations, max_pixels=request["max_pixels"])
+            # Send the response with the modified image back to the bot, in place of the preview if there is one
+            sent_msg = await self.send_result(chat_id, result, preview_msg)
+            self.cache_result(msg, operations, sent_msg, result)
+        except Exception as e:
+            await self.handle_exception(e, chat_id)
+
+    async def concat_media_group(self, chat_id, images, direction=None, sides=None):
+        try:
+            result = await run_cpu(run_concat_job, images, **self.concat_args(images, direction, sides))
+            # Send the response with the modified image back to the bot
+            await self.handle_photo(chat_id, result)
+        except Exception as e:
+            await self.handle_exception(e, chat_id)
+
+class AsyncObjectDetectionBot(AsyncImageProcessingBot, ObjectDetectionBot):
+    """
+    The asyncio counterpart of ObjectDetectionBot, the S3, SQS and DynamoDB calls run on run_blocking
+    """
+    async def handle_message(self, msg):
+        """Object Detection Bot message handler"""
+        logger.info(f"Prediction Bot - incoming message {msg}")
+        chat_id = msg['chat']['id']
+
+        # Check whether a caption was sent and if so assign to variable
+        caption = msg.get("caption", "").strip().lower()
+
+        if "predict" not in caption and "prediction_result" not in caption:
+            await super().handle_message(msg)
+        elif "prediction_result" in caption:
+            try:
+                prediction = self.check_response(await run_blocking(get_from_db, self.parse_prediction_result(msg)))
+                self.check_response(await run_blocking(download_image_from_s3, IMAGES_BUCKET, prediction["originalImgPath"],
+                                                       prediction["originalImgPath"], IMAGES_PREFIX))
+
+                # Send the response with the modified image back to the bot
+                await self.handle_photo(chat_id, Path(prediction["originalImgPath"]), parse_result(prediction))
+            except Exception as e:
+                await self.handle_exception(e, chat_id)
+        elif "predict" in caption:
+            try:
+                image = await self.download_user_photo(msg)
+
+                if not image:
+                    raise Exception("Was unable to download image from Bot.")
+
+                # Let the user that something is happening
+                await self.send_text(chat_id, "Processing, please wait...")
+
+                image_name, message = self.identify_request(msg)
+                self.check_response(await run_blocking(upload_image_to_s3, IMAGES_BUCKET, f"{IMAGES_PREFIX}/{image_name}", image))
+
+                # Send message to the identify queue for the Yolo5 service to pick up
+                self.check_response(await run_blocking(send_to_sqs, QUEUE_IDENTIFY, message))
+            except Exception as e:
+                await self.handle_exception(e, chat_id)
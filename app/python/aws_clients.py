@@ -0,0 +1,89 @@
+from botocore.config import Config
+from loguru import logger
+import threading
+import boto3
+import os
+
+# The maximum number of HTTP connections each client keeps open (botocore's default is 10)
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50'))
+AWS_CONNECT_TIMEOUT      = float(os.getenv('AWS_CONNECT_TIMEOUT', '5'))
+# Must be longer than the 20 seconds the results queue is long polled for
+AWS_READ_TIMEOUT         = float(os.getenv('AWS_READ_TIMEOUT', '60'))
+
+class AWSClients:
+    """
+    A thread-safe, process-wide registry of boto3 clients, created once per service and region and shared by all the threads,
+    so the credentials, the endpoint and the TLS connections are set up once rather than on every call.
+
+    Every client counts its requests in flight. A request sent while all of the client's pooled connections are in use opens
+    a connection which is dropped right after it (urllib3 discards what doesn't fit in the pool), so such requests are counted
+    as saturated: if they're frequent, raise AWS_MAX_POOL_CONNECTIONS.
+    """
+    def __init__(self, max_pool_connections=AWS_MAX_POOL_CONNECTIONS, connect_timeout=AWS_CONNECT_TIMEOUT, read_timeout=AWS_READ_TIMEOUT):
+        self.max_pool_connections = max_pool_connections
+        self.config = Config(max_pool_connections=max_pool_connections, connect_timeout=connect_timeout, read_timeout=read_timeout,
+                             tcp_keepalive=True)
+        # (process id, service, region) -> client
+        self._clients = {}
+        # (service, region) -> the client's counters
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def get(self, service, region_name=None):
+        """
+        Returns the shared client of the service, creating it on first use.
+
+        :param service: The AWS service e.g. 's3', 'sqs'
+        :param region_name: The region, if not the default one
+        """
+        # A forked process must not share the connections of its parent
+        key = (os.getpid(), service, region_name)
+        client = self._clients.get(key)
+
+        if client is None:
+            # boto3's session isn't thread-safe, so the clients are created one at a time
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = boto3.client(service, region_name=region_name, config=self.config)
+                    self._watch(client, (service, region_name))
+                    self._clients[key] = client
+                    logger.info(f"Created the shared {service} client (region {client.meta.region_name})")
+
+        return client
+
+    def _watch(self, client, name) -> None:
+        """
+        Counts the client's requests while they're in flight, i.e. from every attempt's sending until its response or error
+        """
+        # A forked process starts counting anew, with a client of its own
+        stats = self._stats[name] = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "saturated": 0}
+        lock = threading.Lock()
+
+        def before_send(**kwargs):
+            with lock:
+                stats["requests"] += 1
+                stats["in_flight"] += 1
+                stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+                if stats["in_flight"] > self.max_pool_connections:
+                    stats["saturated"] += 1
+
+        def after_send(**kwargs):
+            with lock:
+                stats["in_flight"] -= 1
+
+        client.meta.events.register('before-send', before_send)
+        # Emitted after every attempt, whether it got a response or failed
+        client.meta.events.register('needs-retry', after_send)
+
+    def stats(self) -> dict:
+        """
+        :return: the counters of every client, by service (and region, if not the default one)
+        """
+        with self._lock:
+            clients = {f"{service}:{region_name}" if region_name else service: dict(stats)
+                       for (service, region_name), stats in self._stats.items()}
+
+        return {"max_pool_connections": self.max_pool_connections, "clients": clients}
+
+aws_clients = AWSClients()
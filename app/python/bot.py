@@ -3,15 +3,100 @@ from loguru import logger
 import os
 import time
 import json
+import io
 from pathlib import Path
-from telebot.types import InputFile
-from img_proc import Img
+from telebot.types import InputFile, InputMediaPhoto
+from img_executor import get_image_executor, run_image_job, run_concat_job
+from img_codec import downscale_factor
+from caches import ResultCache, PhotoCache
+from media_groups import MediaGroupCollector
 from bot_utils import upload_image_to_s3, download_image_from_s3, parse_result, send_to_sqs, get_from_db
-import threading
+import functools
 
 IMAGES_BUCKET  = os.environ['BUCKET_NAME']
 IMAGES_PREFIX  = os.environ['BUCKET_PREFIX']
 QUEUE_IDENTIFY = os.environ['SQS_QUEUE_IDENTIFY']
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# When a directory is set the photo cache is kept on the disk, by default it's kept in memory
+PHOTO_CACHE_DIR        = os.getenv('PHOTO_CACHE_DIR', None)
+PHOTO_CACHE_MAX_BYTES  = int(os.getenv('PHOTO_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# The number of pixels each operation needs, as a comma separated list of operation=pixels.
+# The smallest photo rendition Telegram has with at least this many pixels is used, operations not listed use the largest one.
+# blur and salt_n_pepper aren't listed by default, as their blur level and noise are measured in pixels and would look stronger on a smaller image
+PIXEL_BUDGETS          = os.getenv('IMG_PIXEL_BUDGETS', 'contour=1000000,segment=1000000')
+# Operations on photos of at least this many pixels first get a low resolution preview, then the full result (0 - never)
+PROGRESSIVE_MIN_PIXELS = int(os.getenv('PROGRESSIVE_MIN_PIXELS', '1000000'))
+PROGRESSIVE_OPERATIONS = os.getenv('PROGRESSIVE_OPERATIONS', 'blur').split(',')
+PREVIEW_PIXELS         = int(os.getenv('PREVIEW_PIXELS', '100000'))
+# A media group is concatenated once no new photo of it arrived for this many seconds (or it has the maximum number of photos)
+MEDIA_GROUP_WINDOW     = float(os.getenv('MEDIA_GROUP_WINDOW', '1.5'))
+MEDIA_GROUP_MAX_AGE    = float(os.getenv('MEDIA_GROUP_MAX_AGE', '60'))
+MEDIA_GROUP_MAX_IMAGES = int(os.getenv('MEDIA_GROUP_MAX_IMAGES', '10'))
+
+def parse_pixel_budgets(budgets):
+    """
+    Parses a comma separated list of operation=pixels e.g. "contour=1000000,segment=1000000"
+    :return: dict of operation name to number of pixels
+    """
+    parsed = {}
+    for budget in budgets.split(','):
+        if budget.strip():
+            name, pixels = budget.split('=')
+            parsed[name.strip()] = int(pixels)
+
+    return parsed
+
+pixel_budgets = parse_pixel_budgets(PIXEL_BUDGETS)
+
+# Shared by all the image bots, as the factory creates new bot instances all the time
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES)
+photo_cache  = PhotoCache(PHOTO_CACHE_MAX_BYTES, PHOTO_CACHE_DIR)
+media_groups = MediaGroupCollector(MEDIA_GROUP_WINDOW, MEDIA_GROUP_MAX_AGE, MEDIA_GROUP_MAX_IMAGES)
+
+WELCOME_TEXT = '''
+Welcome to the Image Processing Bot!
+
+Upload an image and type in the caption the action you'd like to do.
+
+*NOTE:* You need to type in the words or numbers. For *Concat* you need to upload more than one image
+
+These are the available actions:
+1. *Blue* - blurs the image.
+    a. You may specify noise level by inputting a floating point number
+
+    *example usage: blur 10*
+2. *Contour* - applies a contour effect to the image
+
+    *example usage: contour*
+3. *Rotate* - rotates the image
+    a. You may also input either *clockwise* or *anti-clockwise* (default *clockwise*)
+    b. You may also input the degrees to rotate (default *90*)
+        i. *90*
+        ii. *180*
+        iii. *270*
+    c. You may enter either of the above or both
+
+    *example usage: anti-clockwise 180*
+4. *Salt and pepper* - randomly sprinkle white and black pixels on the image
+    a. You may specify noise level by inputting a floating point number representing the proportion of the image pixels to be affected by noise.
+
+    *example usage: salt and pepper 0.1*
+5. *Concat* - concatenates two or more images
+    a. You may also send the direction of either *horizontal* or *vertical* (default *horizontal*)
+    b. You may also specify the sides to be concatenated based on the direction (default *right-to-left*)
+        i. horizontal: *right-to-left*, *left-to-right*
+        ii. vertical: *top-to-bottom*, *bottom-to-top*
+
+    *example usage: concat vertical top-to-bottom*
+6. *Segment* - represented in a more simplified manner, and so we can then identify objects and boundaries more easily.
+
+    *example usage: segment*
+7. *Predict* - identifies items in the image
+
+    *example usage: predict*
+'''
+
+PREVIEW_CAPTION = "Preview, the full resolution result is on its way..."
 
 class ExceptionHandler(telebot.ExceptionHandler):
     """
@@ -50,32 +135,29 @@ class BotFactory:
     """
     BotFactory class as its name implies, this class makes use of an OO pattern called Factory,
     to generate a bot depending on the incoming message and its parameters.
-    """
-    _lock = threading.Lock()
-    _curr_bot = None
 
-    def __init__(self, token, telegram_chat_url, domain_certificate):
+    The bots are stateless, so a single instance of each is created up front and shared by all the threads handling messages.
+    Any state which has to outlive a message is kept per chat in module level stores e.g. the media groups.
+    """
+    def __init__(self, token, telegram_chat_url, domain_certificate, register_webhook=True):
         self.tgbot = telebot.TeleBot(token)
 
-        # Remove any existing webhooks configured in Telegram servers
-        self.tgbot.remove_webhook()
-        time.sleep(0.5)
+        # When several processes handle the messages only one of them registers the webhook
+        if register_webhook:
+            # Remove any existing webhooks configured in Telegram servers
+            self.tgbot.remove_webhook()
+            time.sleep(0.5)
 
-        # Set the webhook URL
-        self.tgbot.set_webhook(url=f'{telegram_chat_url}:8443/{token}/', certificate=domain_certificate, timeout=90)
-        # self.tgbot.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=90)
+            # Set the webhook URL
+            self.tgbot.set_webhook(url=f'{telegram_chat_url}:8443/{token}/', certificate=domain_certificate, timeout=90)
+            # self.tgbot.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=90)
 
-        logger.info(f'Telegram Bot information\n\n{self.tgbot.get_me()}')
-
-    @property
-    def curr_bot(self):
-        with self._lock:
-            return self._curr_bot
+            logger.info(f'Telegram Bot information\n\n{self.tgbot.get_me()}')
 
-    @curr_bot.setter
-    def curr_bot(self, value):
-        with self._lock:
-            self._curr_bot = value
+        self.bot = Bot(self.tgbot)
+        self.quote_bot = QuoteBot(self.tgbot)
+        self.image_processing_bot = ImageProcessingBot(self.tgbot)
+        self.object_detection_bot = ObjectDetectionBot(self.tgbot)
 
     def is_current_msg_photo(self, msg):
         """
@@ -102,22 +184,21 @@ class BotFactory:
         Get the respective bot based on the incoming message and return the bot instance itself
         """
         logger.info('Getting a bot...')
+        # The flush of a media group collected by the image bot
+        if MediaGroupCollector.is_flush_message(msg):
+            return self.image_processing_bot
         # Check for a reply
-        if self.is_a_reply(msg) and not isinstance(BotFactory.curr_bot, QuoteBot):
-            BotFactory.curr_bot = QuoteBot(self.tgbot)
+        if self.is_a_reply(msg):
+            return self.quote_bot
         # Check for an image
-        elif self.is_current_msg_photo(msg):
-            if self.is_prediction(msg) and not isinstance(BotFactory.curr_bot, ObjectDetectionBot):
+        if self.is_current_msg_photo(msg):
+            if self.is_prediction(msg):
                 # For ObjectDetectionBot with "predict" caption
-                BotFactory.curr_bot = ObjectDetectionBot(self.tgbot)
-            elif not isinstance(BotFactory.curr_bot, ImageProcessingBot):
-                # For general image processing
-                BotFactory.curr_bot = ImageProcessingBot(self.tgbot)
+                return self.object_detection_bot
+            # For general image processing
+            return self.image_processing_bot
         # Fallback basic Bot
-        else:
-            BotFactory.curr_bot = Bot(self.tgbot)
-
-        return BotFactory.curr_bot
+        return self.bot
 
 class Bot:
     """
@@ -125,8 +206,6 @@ class Bot:
     """
     def __init__(self, tgbot):
         self._tgbot = tgbot
-        # Initiate the exception handler
-        self.exception_handler = ExceptionHandler()
 
     def __getattr__(self, name):
         """
@@ -140,57 +219,17 @@ class Bot:
         By using it this way it maintains context hence when the ExceptionHandler sends a message it's as if it was sent
         by the bot itself.
         """
-        self.exception_handler.bot = self
-        self.exception_handler.chat_id = chat_id
-        self.exception_handler.handle(exception)
+        # A handler per exception, as the same bot handles messages of many chats at once
+        exception_handler = ExceptionHandler()
+        exception_handler.bot = self
+        exception_handler.chat_id = chat_id
+        exception_handler.handle(exception)
 
     def send_welcome(self, chat_id):
         """
         This method is used to both greet and give instructions to the user.
         """
-        text = '''
-Welcome to the Image Processing Bot!
-
-Upload an image and type in the caption the action you'd like to do.
-
-*NOTE:* You need to type in the words or numbers. For *Concat* you need to upload more than one image
-
-These are the available actions:
-1. *Blue* - blurs the image.
-    a. You may specify noise level by inputting a floating point number
-
-    *example usage: blur 10*
-2. *Contour* - applies a contour effect to the image
-
-    *example usage: contour*
-3. *Rotate* - rotates the image
-    a. You may also input either *clockwise* or *anti-clockwise* (default *clockwise*)
-    b. You may also input the degrees to rotate (default *90*)
-        i. *90*
-        ii. *180*
-        iii. *270*
-    c. You may enter either of the above or both
-
-    *example usage: anti-clockwise 180*
-4. *Salt and pepper* - randomly sprinkle white and black pixels on the image
-    a. You may specify noise level by inputting a floating point number representing the proportion of the image pixels to be affected by noise.
-
-    *example usage: salt and pepper 0.1*
-5. *Concat* - concatenates two or more images
-    a. You may also send the direction of either *horizontal* or *vertical* (default *horizontal*)
-    b. You may also specify the sides to be concatenated based on the direction (default *right-to-left*)
-        i. horizontal: *right-to-left*, *left-to-right*
-        ii. vertical: *top-to-bottom*, *bottom-to-top*
-
-    *example usage: concat vertical top-to-bottom*
-6. *Segment* - represented in a more simplified manner, and so we can then identify objects and boundaries more easily.
-
-    *example usage: segment*
-7. *Predict* - identifies items in the image
-
-    *example usage: predict*
-'''
-        self.send_message(chat_id, text, parse_mode="Markdown")
+        self.send_message(chat_id, WELCOME_TEXT, parse_mode="Markdown")
 
     def send_text(self, chat_id, text):
         """
@@ -198,6 +237,14 @@ These are the available actions:
         """
         self.send_message(chat_id, text)
 
+    def defer_ack(self, msg, ack) -> bool:
+        """
+        Called once the message was handled, a bot which isn't done with it yet holds its ack until it is.
+        :param ack: callable() - acks the message in the message queue
+        :return: True if the bot holds the ack, otherwise the caller acks the message right away
+        """
+        return False
+
     def handle_message(self, msg):
         """Bot Main message handler"""
         logger.info(f'Regular Bot - incoming message: {msg}')
@@ -238,199 +285,475 @@ class ImageProcessingBot(Bot):
     This bot is an extension of the original bot and is dedicated for image processing operations
     """
 
-    def __init__(self, tgbot):
-        super().__init__(tgbot)
-        self.media_groups = {}
-        self.direction = None
-        self.sides = None
+    def select_photo_size(self, msg, operations=None):
+        """
+        Picks the photo rendition to download for the operations, using the sizes Telegram sends along with the photo.
+        It's the smallest rendition with at least as many pixels as the operations need, or the largest one if none has.
+        :return: tuple of (the rendition's dict, the pixel budget or None if the operations need full resolution)
+        """
+        budgets = [pixel_budgets.get(name) for name, _ in (operations or [])]
+
+        if not budgets or None in budgets:
+            return msg['photo'][-1], None
 
-    def download_user_photo(self, msg):
+        budget = max(budgets)
+        return self.smallest_photo_size(msg, budget), budget
+
+    def smallest_photo_size(self, msg, pixels):
         """
-        Downloads the photos that sent to the Bot to `photos` directory (should be existed)
-        :return file_info.file_path:
+        :return: the smallest photo rendition with at least this many pixels, or the largest one if none has
         """
-        file_info = self.get_file(msg['photo'][-1]['file_id'])
-        data = self.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
+        for photo_size in sorted(msg['photo'], key=lambda size: size.get('width', 0) * size.get('height', 0)):
+            if photo_size.get('width', 0) * photo_size.get('height', 0) >= pixels:
+                return photo_size
+
+        return msg['photo'][-1]
+
+    def decoded_pixels(self, photo_size, max_pixels):
+        """
+        :return: the number of pixels the rendition will have once decoded with the pixel budget
+        """
+        width, height = photo_size.get('width', 0), photo_size.get('height', 0)
+        factor = downscale_factor(width, height, max_pixels)
+        return (width // factor) * (height // factor)
+
+    def is_progressive(self, operations, photo_size, max_pixels):
+        """
+        Whether the operations are slow enough on this photo to send a low resolution preview first
+        """
+        return (PROGRESSIVE_MIN_PIXELS > 0
+                and any(name in PROGRESSIVE_OPERATIONS for name, _ in operations)
+                and self.decoded_pixels(photo_size, max_pixels) >= PROGRESSIVE_MIN_PIXELS)
+
+    def scale_operations(self, operations, scale):
+        """
+        Adapts the operations to an image scaled down by a factor, so the result looks the same at the smaller size.
+        Only the blur level is measured in pixels, so it's the only one that's scaled.
+        """
+        scaled = []
+        for name, kwargs in operations:
+            if name == "blur":
+                try:
+                    kwargs = dict(kwargs, blur_level=max(1, round(abs(int(kwargs.get("blur_level", 16))) * scale)))
+                except (TypeError, ValueError):
+                    # Left as is, the job reports the invalid blur level
+                    pass
+
+            scaled.append((name, kwargs))
+
+        return scaled
+
+    def plan_preview(self, msg, operations, photo_size, max_pixels):
+        """
+        Whether the operations are slow enough on this photo to send a low resolution preview first, and how to make it.
+        :return: tuple of (the rendition to preview, the operations scaled to it), or None if there's no preview
+        """
+        if not operations or not self.is_progressive(operations, photo_size, max_pixels):
+            return None
+
+        preview_size = self.smallest_photo_size(msg, PREVIEW_PIXELS)
+        scale = (self.decoded_pixels(preview_size, PREVIEW_PIXELS) / self.decoded_pixels(photo_size, max_pixels)) ** 0.5
+
+        if scale >= 1:
+            # No rendition is smaller than the full resolution one
+            return None
 
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
+        return preview_size, self.scale_operations(operations, scale)
 
+    def send_preview(self, chat_id, msg, preview):
+        """
+        Runs the operations on a small rendition of the photo and sends the result as a preview.
+        :param preview: tuple of (the rendition, the scaled operations), see plan_preview
+        :return: the sent preview message, or None if it couldn't be sent
+        """
         try:
-            with open(file_info.file_path, 'wb') as photo:
-                photo.write(data)
-        except OSError as e:
-            self.handle_exception(e, msg["chat"]["id"])
+            preview_size, operations = preview
+            image = self.download_user_photo(msg, preview_size)
+            data = get_image_executor().submit(run_image_job, image, operations, max_pixels=PREVIEW_PIXELS).result()
+
+            return self.send_photo(chat_id, InputFile(io.BytesIO(data)), caption=PREVIEW_CAPTION)
+        except Exception as e:
+            # The full result follows anyway, so a failed preview is only logged
+            logger.warning(f"Was unable to send a preview.\n{e}")
+            return None
+
+    def result_photo(self, result):
+        """
+        :param result: bytes - the encoded result, or a cached result's dict
+        :return: the photo to send: the cached result's Telegram file_id, or a new upload of the encoded result
+        """
+        if isinstance(result, dict):
+            return result["file_id"]
+
+        return InputFile(io.BytesIO(result))
+
+    def send_result(self, chat_id, result, preview_msg=None):
+        """
+        Sends the result, replacing the preview in place when there is one.
+        :param result: bytes - the encoded result, or a cached result's dict
+        :return: the sent (or edited) message
+        """
+        photo = self.result_photo(result)
+
+        if preview_msg:
+            try:
+                return self.edit_message_media(media=InputMediaPhoto(photo), chat_id=chat_id, message_id=preview_msg.message_id)
+            except Exception as e:
+                logger.warning(f"Was unable to replace the preview, sending the result separately.\n{e}")
+                # The failed upload may have consumed it
+                photo = self.result_photo(result)
+
+        if isinstance(result, dict):
+            self.send_cached_result(chat_id, result)
             return None
 
-        return file_info.file_path
+        return self.send_photo(chat_id, photo)
+
+    def cached_photo(self, photo):
+        """
+        The same photo (re-sent, retried or a media group member) is served from the photo cache without calling Telegram
+        :param photo: The rendition's dict
+        :return: bytes - the content of the photo, or None if it isn't cached
+        """
+        data = photo_cache.get_photo(photo.get('file_unique_id'))
+        if data:
+            logger.info(f"Photo cache hit for {photo.get('file_unique_id')}")
+
+        return data
 
-    def handle_photo(self, chat_id, img_path, caption=""):
+    def cache_photo(self, photo, data, file_path):
+        """
+        Adds a downloaded photo to the photo cache.
+        :param file_path: The photo's path on Telegram's servers, whose extension the cached file gets
+        """
+        try:
+            photo_cache.put_photo(photo.get('file_unique_id'), data, os.path.splitext(file_path)[1])
+        except OSError as e:
+            # The photo was downloaded, failing to cache it shouldn't fail the request
+            logger.warning(f"Was unable to cache the photo.\n{e}")
+
+    def download_user_photo(self, msg, photo=None):
+        """
+        Downloads the photo that was sent to the Bot into memory, unless it's already in the photo cache
+        :param photo: The rendition to download (default the largest one)
+        :return: bytes - the content of the photo
+        """
+        photo = photo or msg['photo'][-1]
+
+        data = self.cached_photo(photo)
+        if data:
+            return data
+
+        file_info = self.get_file(photo['file_id'])
+        data = self.download_file(file_info.file_path)
+        self.cache_photo(photo, data, file_info.file_path)
+
+        return data
+
+    def photo_file(self, img):
+        """
+        :param img: The path of the image file, or the encoded image's bytes
+        :return: the InputFile to send
+        """
+        if isinstance(img, (bytes, bytearray)):
+            return InputFile(io.BytesIO(img))
+
+        if not img.is_file():
+            raise FileNotFoundError("Image doesn't exist or it's not a file.")
+
+        return InputFile(img)
+
+    def handle_photo(self, chat_id, img, caption=""):
         """
         This method is used to send images to the user
+        :param img: The path of the image file, or the encoded image's bytes
+        :return: the sent message, or None if the image couldn't be sent
         """
         try:
-            if not img_path.exists() and img_path.is_file():
-                raise FileNotFoundError("Image doesn't exist or it's not a file.")
+            photo = self.photo_file(img)
         except FileNotFoundError as e:
             self.handle_exception(e, chat_id)
-            return
+            return None
 
         if not caption:
-            self.send_photo(
+            return self.send_photo(
                 chat_id,
-                InputFile(img_path)
+                photo
             )
         else:
-            self.send_photo(
+            return self.send_photo(
                 chat_id,
-                InputFile(img_path),
+                photo,
                 caption=caption
             )
 
-    def handle_message(self, msg):
-        """Image Bot message handler"""
-        logger.info(f"Image Processing Bot - incoming message {msg}")
-        chat_id = msg['chat']['id']
+    def send_cached_result(self, chat_id, cached):
+        """
+        Sends a cached result by its Telegram file_id, so nothing needs to be uploaded.
+        If Telegram no longer accepts the file_id the cached bytes are uploaded instead.
+        """
+        try:
+            self.send_photo(chat_id, cached["file_id"])
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f"Cached file_id was rejected, uploading the cached result instead.\n{e}")
+            self.send_photo(chat_id, InputFile(io.BytesIO(cached["data"])))
 
+    def cached_result(self, msg, operations):
+        """
+        :return: the result already sent for the same photo and operations, or None
+        """
+        return result_cache.get_result(msg['photo'][-1].get('file_unique_id'), operations)
+
+    def cache_result(self, msg, operations, sent_msg, data):
+        """
+        Caches the result just sent for the source photo and operations, keyed by the photo's file_unique_id.
+        """
+        try:
+            if sent_msg and sent_msg.photo:
+                result_cache.put_result(msg['photo'][-1].get('file_unique_id'), operations, sent_msg.photo[-1].file_id, data)
+        except Exception as e:
+            # A failure to cache must never fail the request itself
+            logger.warning(f"Was unable to cache the result.\n{e}")
+
+    def parse_request(self, msg):
+        """
+        Works out from the photo's caption what's to be done with it. The sync and async bots share it, it does no I/O.
+
+        :return: dict of
+                 "concat": whether the photo is to be concatenated with the rest of its media group,
+                 "direction" and "sides": the concatenation's, if the caption has them (it comes with only one of the group's photos),
+                 "operations": the operations to execute on the photo otherwise, see get_operations,
+                 "photo_size" and "max_pixels": the rendition to download and the pixel budget to decode it with, see select_photo_size
+        :raises ValueError, RuntimeError: if the caption doesn't ask for anything the bot can do, with the error for the user
+        """
         # Check whether a caption was sent and if so assign to variable
         caption = msg.get("caption", "").strip().lower()
         # Check wether the incoming image is part of a media group i.e. more than one image was sent
         media_group_id = msg.get("media_group_id", None)
-        try:
-            if not caption and not media_group_id:
-                raise RuntimeError("Please specify an action you'd like to execute on the image.\nIf you're unsure, please refer to 'help' for assistance.")
 
-            if caption:
-                if not any(substring in caption for substring in ["blur", "contour", "rotate", "salt and pepper", "concat", "segment"]):
-                    raise ValueError("Invalid image action specified. Please refer to the 'help' for assistance.")
+        if not caption and not media_group_id:
+            raise RuntimeError("Please specify an action you'd like to execute on the image.\nIf you're unsure, please refer to 'help' for assistance.")
 
-                if "concat" in caption and not media_group_id:
-                    raise RuntimeError("You need to upload more than one image in order to concat.")
-        except ValueError as e:
-            self.handle_exception(e, chat_id)
+        if caption:
+            if not any(substring in caption for substring in ["blur", "contour", "rotate", "salt and pepper", "concat", "segment"]):
+                raise ValueError("Invalid image action specified. Please refer to the 'help' for assistance.")
+
+            if "concat" in caption and not media_group_id:
+                raise RuntimeError("You need to upload more than one image in order to concat.")
+
+        request = {"concat": bool((caption and "concat" in caption) or media_group_id), "direction": None, "sides": None, "operations": []}
+
+        if request["concat"]:
+            instruction = caption.replace("concat", "").strip()
+
+            if instruction:
+                for substring in ["horizontal", "vertical"]:
+                    if substring in instruction:
+                        request["direction"] = substring
+                        break
+                if request["direction"]:
+                    instruction = instruction.replace(request["direction"], "").strip()
+
+                if instruction:
+                    request["sides"] = instruction
+        else:
+            request["operations"] = self.get_operations(caption)
+
+        # Only as large a rendition as the operations need is downloaded, and it's downscaled further on decoding if it's still too large
+        request["photo_size"], request["max_pixels"] = self.select_photo_size(msg, request["operations"])
+
+        return request
+
+    def add_to_media_group(self, msg, request, image, on_complete):
+        """
+        Adds the photo to its media group, whose photos are all concatenated together once they've all arrived
+        :param on_complete: callable(images, **options) - concatenates the complete group
+        :return: True if it's the first photo of the group
+        """
+        return media_groups.add(msg['chat']['id'], msg['media_group_id'], msg.get("message_id", 0), image, on_complete,
+                                msg.get("received_at"), direction=request["direction"], sides=request["sides"])
+
+    def handle_message(self, msg):
+        """Image Bot message handler"""
+        logger.info(f"Image Processing Bot - incoming message {msg}")
+        chat_id = msg['chat']['id']
+
+        # Queued once no new photo of the group arrived within the window, unless one was received since
+        if MediaGroupCollector.is_flush_message(msg):
+            media_groups.flush(chat_id, msg['media_group_id'])
             return
-        except RuntimeError as e:
+
+        try:
+            request = self.parse_request(msg)
+        except (ValueError, RuntimeError) as e:
             self.handle_exception(e, chat_id)
             return
 
-        image_path = self.download_user_photo(msg)
+        operations = request["operations"]
+
+        # A photo which was already processed the same way is answered by re-sending the previous result
+        cached = self.cached_result(msg, operations)
+        if cached:
+            try:
+                self.send_cached_result(chat_id, cached)
+                return
+            except Exception as e:
+                logger.warning(f"Was unable to send the cached result, processing the image again.\n{e}")
+
+        # A slow operation on a large photo first gets a quick low resolution preview
+        preview = self.plan_preview(msg, operations, request["photo_size"], request["max_pixels"])
+        preview_msg = self.send_preview(chat_id, msg, preview) if preview else None
 
         try:
-            if not image_path:
+            image = self.download_user_photo(msg, request["photo_size"])
+            if not image:
                 raise Exception("Was unable to download image from Bot.")
-
-            img = Img(image_path)
         except Exception as e:
             self.handle_exception(e, chat_id)
             return
 
-        # Let the user that something is happening
-        self.send_text(chat_id, "Processing, please wait...")
+        if request["concat"]:
+            if self.add_to_media_group(msg, request, image, functools.partial(self.concat_media_group, chat_id)):
+                # Let the user that something is happening
+                self.send_text(chat_id, "Processing, please wait...")
+            return
 
-        if (caption and "concat" in caption) or media_group_id:
-            if caption:
-                instruction = caption.replace("concat", "").strip()
+        if not preview_msg:
+            # Let the user that something is happening
+            self.send_text(chat_id, "Processing, please wait...")
 
-                if instruction:
-                    for substring in ["horizontal", "vertical"]:
-                        if substring in instruction:
-                            self.direction = substring
-                            break
-                    if self.direction:
-                        instruction = instruction.replace(self.direction, "").strip()
+        try:
+            if preview_msg:
+                # The same result may have been sent (and cached) while the preview was being made
+                cached = self.cached_result(msg, operations)
+                if cached:
+                    self.send_result(chat_id, cached, preview_msg)
+                    return
 
-                    if instruction:
-                        self.sides = instruction
+            # The decoding, operations and encoding run on the image executor, off this thread
+            result = get_image_executor().submit(run_image_job, image, operations, max_pixels=request["max_pixels"]).result()
+            # Send the response with the modified image back to the bot, in place of the preview if there is one
+            sent_msg = self.send_result(chat_id, result, preview_msg)
+            self.cache_result(msg, operations, sent_msg, result)
+        except Exception as e:
+            self.handle_exception(e, chat_id)
 
-            # Initialize the group in the dictionary if it doesn't exist
-            if media_group_id not in self.media_groups:
-                self.media_groups[media_group_id] = []
+    def defer_ack(self, msg, ack) -> bool:
+        """
+        The photos of a media group are acked once the whole group was concatenated
+        """
+        if "media_group_id" not in msg or MediaGroupCollector.is_flush_message(msg):
+            return False
 
-            self.media_groups[media_group_id].append(img)
+        return media_groups.hold(msg['chat']['id'], msg['media_group_id'], ack)
 
-            if len(self.media_groups[media_group_id]) > 1:
-                try:
-                    if self.direction and self.sides:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1], self.direction, self.sides)
-                    elif self.direction:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1], direction=self.direction)
-                    elif self.sides:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1], sides=self.sides)
-                    else:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1])
-
-                    image_path = self.media_groups[media_group_id][0].save_img()
-                    # Send the response with the modified image back to the bot
-                    self.handle_photo(chat_id, image_path)
-                except ValueError as e:
-                    self.handle_exception(e, chat_id)
-                    return
-                except RuntimeError as e:
-                    self.handle_exception(e, chat_id)
-                    return
-                except Exception as e:
-                    self.handle_exception(e, chat_id)
-                    return
-                finally:
-                    # Clean the handled group from the media groups dictionary and reset the direction and sides
-                    del self.media_groups[media_group_id]
-                    self.direction = None
-                    self.sides = None
-        else:
-            try:
-                if "blur" in caption:
-                    blur_level = caption.replace("blur", "").strip()
-                    if blur_level:
-                        img.blur(blur_level)
-                    else:
-                        img.blur()
-                elif "contour" in caption:
-                    img.contour()
-                elif "rotate" in caption:
-                    direction = None
-                    degree = None
-                    instruction = caption.replace("rotate", "").strip()
-                    if instruction:
-                        for substring in ["anti-clockwise", "clockwise"]:
-                            if substring in instruction:
-                                direction = substring
-                                break
-                        if direction:
-                            instruction = instruction.replace(direction, "").strip()
-
-                        if instruction:
-                            degree = instruction
-
-                    if direction and degree:
-                        img.rotate(direction, degree)
-                    elif direction:
-                        img.rotate(direction=direction)
-                    elif degree:
-                        img.rotate(deg=degree)
-                    else:
-                        img.rotate()
-                elif "salt and pepper" in caption:
-                    noise_level = caption.replace("salt and pepper", "").strip()
-                    if noise_level:
-                        img.salt_n_pepper(noise_level)
-                    else:
-                        img.salt_n_pepper()
-                elif "segment" in caption:
-                    img.segment()
-
-                image_path = img.save_img()
-                # Send the response with the modified image back to the bot
-                self.handle_photo(chat_id, image_path)
-            except ValueError as e:
-                self.handle_exception(e, chat_id)
-            except Exception as e:
-                self.handle_exception(e, chat_id)
+    def concat_args(self, images, direction=None, sides=None):
+        """
+        :param images: list of the media group's photos
+        :return: dict of the keyword arguments of the concatenation job
+        """
+        if len(images) < 2:
+            raise RuntimeError("You need to upload more than one image in order to concat.")
+
+        concat_args = {}
+        if direction:
+            concat_args["direction"] = direction
+        if sides:
+            concat_args["sides"] = sides
+
+        return concat_args
+
+    def concat_media_group(self, chat_id, images, direction=None, sides=None):
+        """
+        Concatenates all the photos of a complete media group and sends the result.
+        :param images: list of the photos' bytes, in the order they were sent
+        """
+        try:
+            concat_args = self.concat_args(images, direction, sides)
+            # The decoding, concatenation and encoding run on the image executor, off this thread
+            result = get_image_executor().submit(run_concat_job, images, **concat_args).result()
+            # Send the response with the modified image back to the bot
+            self.handle_photo(chat_id, result)
+        except Exception as e:
+            self.handle_exception(e, chat_id)
+
+    def get_operations(self, caption):
+        """
+        Translates the caption into the list of image operations to execute
+
+        :param caption: The user's caption, stripped and lower cased
+        :return: list of (operation name, keyword arguments dict) tuples
+        """
+        if "blur" in caption:
+            blur_level = caption.replace("blur", "").strip()
+            if blur_level:
+                return [("blur", {"blur_level": blur_level})]
+            return [("blur", {})]
+        elif "contour" in caption:
+            return [("contour", {})]
+        elif "rotate" in caption:
+            rotate_args = {}
+            instruction = caption.replace("rotate", "").strip()
+            if instruction:
+                for substring in ["anti-clockwise", "clockwise"]:
+                    if substring in instruction:
+                        rotate_args["direction"] = substring
+                        break
+                if "direction" in rotate_args:
+                    instruction = instruction.replace(rotate_args["direction"], "").strip()
+
+                if instruction:
+                    rotate_args["deg"] = instruction
+
+            return [("rotate", rotate_args)]
+        elif "salt and pepper" in caption:
+            noise_level = caption.replace("salt and pepper", "").strip()
+            if noise_level:
+                return [("salt_n_pepper", {"noise_level": noise_level})]
+            return [("salt_n_pepper", {})]
+        elif "segment" in caption:
+            return [("segment", {})]
+
+        return []
 
 class ObjectDetectionBot(ImageProcessingBot):
     """
     The ObjectDetectionBot class is an extension to the ImageProcessingBot class and essentially extends its functionality to detect items in a user sent image.
     """
+    def check_response(self, response):
+        """
+        :param response: tuple of (message, status) as returned by bot_utils
+        :return: the message, if the status is 200
+        """
+        if int(response[1]) != 200:
+            raise Exception(response[0])
+
+        return response[0]
+
+    def parse_prediction_result(self, msg):
+        """
+        :param msg: The result of the object detection service, received from the results queue
+        :return: the prediction's id
+        """
+        if int(msg["status_code"]) != 200:
+            raise Exception(msg["text"])
+
+        return msg["text"]["prediction_id"]
+
+    def identify_request(self, msg):
+        """
+        :return: tuple of (the name the photo is uploaded to S3 with, the message for the identify queue)
+        """
+        # Telegram photos are always JPEG, the name is content-addressed like the photo cache
+        image_name = f"{msg['photo'][-1]['file_unique_id']}.jpg"
+
+        message_dict = {
+            "chatId": str(msg['chat']['id']),
+            "imgName": image_name
+        }
+
+        return image_name, json.dumps(message_dict)
+
     def handle_message(self, msg):
         """Object Detection Bot message handler"""
         logger.info(f"Prediction Bot - incoming message {msg}")
@@ -443,60 +766,27 @@ class ObjectDetectionBot(ImageProcessingBot):
             super().handle_message(msg)
         elif "prediction_result" in caption:
             try:
-                response_data = msg["text"]
-
-                if int(msg["status_code"]) != 200:
-                    raise Exception(response_data)
-
-                prediction_id = response_data["prediction_id"]
-
-                response_data = get_from_db(prediction_id)
-
-                if int(response_data[1]) != 200:
-                    raise Exception(response_data[0])
-
-                response = download_image_from_s3(IMAGES_BUCKET, response_data[0]["originalImgPath"], response_data[0]["originalImgPath"], IMAGES_PREFIX)
-
-                if int(response[1]) != 200:
-                    raise Exception(response[0])
+                prediction = self.check_response(get_from_db(self.parse_prediction_result(msg)))
+                self.check_response(download_image_from_s3(IMAGES_BUCKET, prediction["originalImgPath"], prediction["originalImgPath"], IMAGES_PREFIX))
 
-                parsed_results = ""
-                try:
-                    parsed_results = parse_result(response_data[0])
-                except Exception as e:
-                    raise e
-
-                image_path = Path(response_data[0]["originalImgPath"])
                 # Send the response with the modified image back to the bot
-                self.handle_photo(chat_id, image_path, parsed_results)
+                self.handle_photo(chat_id, Path(prediction["originalImgPath"]), parse_result(prediction))
             except Exception as e:
                 self.handle_exception(e, chat_id)
         elif "predict" in caption:
-            image_path = self.download_user_photo(msg)
-
             try:
-                if not image_path:
+                image = self.download_user_photo(msg)
+
+                if not image:
                     raise Exception("Was unable to download image from Bot.")
 
                 # Let the user that something is happening
                 self.send_text(chat_id, "Processing, please wait...")
 
-                image_name = os.path.basename(image_path)
-
-                response = upload_image_to_s3(IMAGES_BUCKET, f"{IMAGES_PREFIX}/{image_name}", image_path)
-
-                if int(response[1]) != 200:
-                    raise Exception(f"{response[0]}")
-
-                message_dict = {
-                    "chatId": str(chat_id),
-                    "imgName": image_name
-                }
+                image_name, message = self.identify_request(msg)
+                self.check_response(upload_image_to_s3(IMAGES_BUCKET, f"{IMAGES_PREFIX}/{image_name}", image))
 
                 # Send message to the identify queue for the Yolo5 service to pick up
-                response = send_to_sqs(QUEUE_IDENTIFY, json.dumps(message_dict))
-
-                if int(response[1]) != 200:
-                    raise Exception(response[0])
+                self.check_response(send_to_sqs(QUEUE_IDENTIFY, message))
             except Exception as e:
                 self.handle_exception(e, chat_id)
@@ -5,6 +5,7 @@ from collections import Counter
 import os
 import json
 from boto3.dynamodb.types import TypeDeserializer
+from aws_clients import aws_clients
 
 aws_profile = os.getenv("AWS_PROFILE", None)
 if aws_profile is not None and aws_profile == "dev":
@@ -14,7 +15,7 @@ TABLE_NAME = os.environ['TABLE_NAME']
 
 def get_secret_value(region_name, secret_name, key_name=None):
     try:
-        secret_manager = boto3.client('secretsmanager', region_name)
+        secret_manager = aws_clients.get('secretsmanager', region_name)
     except boto_exceptions.ProfileNotFound as e:
         logger.exception(f"Retrieval of secret {secret_name} failed. A ProfileNotFound has occurred.\n{str(e)}")
         return f"Retrieval of secret {secret_name} failed. A ProfileNotFound has occurred.", 500
@@ -72,9 +73,9 @@ def get_secret_value(region_name, secret_name, key_name=None):
     logger.info(f"Fetching secret: {secret_name}, succeeded.")
     return secret_value, 200
 
-def upload_image_to_s3(bucket_name, key, image_path):
+def upload_image_to_s3(bucket_name, key, image):
     try:
-        s3_client = boto3.client('s3')
+        s3_client = aws_clients.get('s3')
     except boto_exceptions.ProfileNotFound as e:
         logger.exception(f"Upload to {bucket_name}/{key} failed. A ProfileNotFound has occurred.\n{str(e)}")
         return f"Upload to {bucket_name}/{key} failed. A ProfileNotFound has occurred.", 500
@@ -92,8 +93,11 @@ def upload_image_to_s3(bucket_name, key, image_path):
         return f"Upload to {bucket_name}/{key} failed. An Unknown {type(e).__name__} has occurred.", 500
 
     try:
-        with open(image_path, 'rb') as img:
-            s3_client.put_object(Bucket=bucket_name, Key=key, Body=img)
+        if isinstance(image, (bytes, bytearray)):
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=image)
+        else:
+            with open(image, 'rb') as img:
+                s3_client.put_object(Bucket=bucket_name, Key=key, Body=img)
     except FileNotFoundError as e:
         logger.exception(f"Upload to {bucket_name}/{key} failed. A FileNotFoundError has occurred.\n{str(e)}")
         return f"Upload to {bucket_name}/{key} failed. A FileNotFoundError has occurred.", 500
@@ -124,7 +128,7 @@ def download_image_from_s3(bucket_name, key, image_path, images_prefix):
         os.makedirs(images_prefix)
 
     try:
-        s3_client = boto3.client('s3')
+        s3_client = aws_clients.get('s3')
     except boto_exceptions.ProfileNotFound as e:
         logger.exception(f"Download from {bucket_name}/{key} failed. A ProfileNotFound has occurred.\n{str(e)}")
         return f"Download from {bucket_name}/{key} failed. A ProfileNotFound has occurred.", 500
@@ -175,7 +179,7 @@ def dynamodb_to_dict(item):
 
 def get_from_db(prediction_id):
     try:
-        dynamodb_client = boto3.client('dynamodb')
+        dynamodb_client = aws_clients.get('dynamodb')
     except boto_exceptions.ProfileNotFound as e:
         logger.exception(f"Reading from dynamodb failed. A ProfileNotFound has occurred.\n{str(e)}")
         return f"Reading from dynamodb failed. A ProfileNotFound has occurred.", 500
@@ -229,7 +233,7 @@ def get_from_db(prediction_id):
 
 def send_to_sqs(queue_name, message_body):
     try:
-        sqs_client = boto3.client('sqs')
+        sqs_client = aws_clients.get('sqs')
     except boto_exceptions.ProfileNotFound as e:
         logger.exception(f"Sending message to SQS failed. A ProfileNotFound has occurred.\n{str(e)}")
         return f"Sending message to SQS failed. A ProfileNotFound has occurred.", 500
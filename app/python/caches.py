@@ -0,0 +1,329 @@
+from collections import OrderedDict
+from loguru import logger
+import threading
+import time
+import os
+
+class ByteLRUCache:
+    """
+    A thread-safe LRU cache bounded by the total byte size of its values rather than by their number.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return self._nbytes
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the value cached for the key and marks it as the most recently used, or None if there is none.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """
+        Caches a value, evicting the least recently used values until the cache fits within max_bytes.
+        The value just cached is never evicted by its own put, so a value larger than the whole cache
+        is kept alone until the next one is cached.
+
+        :param key: A hashable key
+        :param value: The value to cache
+        :param nbytes: The byte size the value is accounted for
+        :return None:
+        """
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, (evicted_value, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+                self._on_evict(evicted_key, evicted_value)
+
+    def pop(self, key):
+        """
+        Removes the key from the cache and returns its value, or None if it isn't cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            value, nbytes = self._entries.pop(key)
+            self._nbytes -= nbytes
+            return value
+
+    def _on_evict(self, key, value):
+        """
+        Called (under the lock) for every value evicted to make room, subclasses may release resources here.
+        """
+        pass
+
+class ResultCache(ByteLRUCache):
+    """
+    Caches the results of image operations already sent to users, so a re-sent photo or a retried caption
+    can be answered by re-sending the same Telegram photo instead of downloading and processing it again.
+
+    The key is the Telegram file_unique_id of the source photo together with the normalized operations
+    and the value holds the file_id Telegram assigned to the sent result and the result's encoded bytes,
+    which are used to upload it again if the file_id is rejected.
+    """
+    def get_result(self, file_unique_id, operations):
+        """
+        :param file_unique_id: The Telegram file_unique_id of the source photo
+        :param operations: list of (operation name, keyword arguments dict) tuples
+        :return: dict with "file_id" and "data", or None
+        """
+        key = self.make_key(file_unique_id, operations)
+        if key is None:
+            return None
+
+        result = self.get(key)
+        if result:
+            logger.info(f"Result cache hit for {key}")
+
+        return result
+
+    def put_result(self, file_unique_id, operations, file_id, data):
+        """
+        :param file_unique_id: The Telegram file_unique_id of the source photo
+        :param operations: list of (operation name, keyword arguments dict) tuples
+        :param file_id: The Telegram file_id of the sent result
+        :param data: bytes - the encoded result
+        :return None:
+        """
+        key = self.make_key(file_unique_id, operations)
+        if key is None:
+            return
+
+        self.put(key, {"file_id": file_id, "data": data}, len(data) + len(file_id))
+
+    @staticmethod
+    def make_key(file_unique_id, operations):
+        """
+        Normalizes the operations so equivalent requests share a key, e.g. "rotate clockwise 270" and "rotate anti-clockwise".
+        Returns None when the result shouldn't be cached: random operations, or parameters which are invalid
+        (their job will report the error).
+        """
+        normalized = []
+
+        try:
+            for name, kwargs in operations:
+                if name == "blur":
+                    normalized.append(("blur", abs(int(kwargs.get("blur_level", 16)))))
+                elif name == "rotate":
+                    direction = kwargs.get("direction", "clockwise")
+                    deg = abs(int(kwargs.get("deg", 90)))
+                    if deg not in [90, 180, 270]:
+                        return None
+
+                    quarter_turns = deg // 90
+                    if direction == "clockwise":
+                        quarter_turns = -quarter_turns
+                    elif direction != "anti-clockwise":
+                        quarter_turns = 0
+                    normalized.append(("rotate", quarter_turns % 4))
+                elif name in ["contour", "segment"]:
+                    normalized.append((name,))
+                else:
+                    # e.g. salt and pepper, which is expected to come out different every time
+                    return None
+        except (TypeError, ValueError):
+            return None
+
+        if not file_unique_id or not normalized:
+            return None
+
+        return file_unique_id, tuple(normalized)
+
+class PhotoCache(ByteLRUCache):
+    """
+    A content-addressed local cache of the photos downloaded from Telegram.
+
+    Telegram's file_unique_id is the same for the same file whoever sent it, so it's used as the key.
+    The cache is bounded by the total size of the photos and evicts the least recently used ones.
+    Without a directory the photos are kept in memory, otherwise every photo is a file in the directory
+    (named after its file_unique_id) which is deleted from the disk when it's evicted.
+    """
+    def __init__(self, max_bytes, directory=None):
+        super().__init__(max_bytes)
+        self.directory = directory
+
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Index the photos left over from a previous run, the oldest ones first so they're evicted first
+        leftovers = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                leftovers.append((stat.st_mtime, entry.name, entry.path, stat.st_size))
+
+        for _, name, path, size in sorted(leftovers):
+            self.put(os.path.splitext(name)[0], path, size)
+
+    def get_photo(self, file_unique_id):
+        """
+        :param file_unique_id: The Telegram file_unique_id of the photo
+        :return: bytes - the content of the cached photo, or None if it isn't cached
+        """
+        if not file_unique_id:
+            return None
+
+        value = self.get(file_unique_id)
+
+        if not self.directory or value is None:
+            return value
+
+        try:
+            with open(value, 'rb') as photo:
+                return photo.read()
+        except OSError:
+            # Removed from the disk behind the cache's back
+            self.pop(file_unique_id)
+            return None
+
+    def put_photo(self, file_unique_id, data, suffix=""):
+        """
+        Adds a downloaded photo to the cache.
+
+        :param file_unique_id: The Telegram file_unique_id of the photo
+        :param data: bytes - the photo file's content
+        :param suffix: The file extension, e.g. ".jpg", used for the file name in a cache directory
+        :return None:
+        """
+        if not file_unique_id:
+            return
+
+        if not self.directory:
+            self.put(file_unique_id, data, len(data))
+            return
+
+        path = os.path.join(self.directory, f"{file_unique_id}{suffix}")
+
+        # Written to a temporary file first, so a concurrent reader never sees a partially written photo
+        tmp_path = os.path.join(self.directory, f".{file_unique_id}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as photo:
+            photo.write(data)
+        os.replace(tmp_path, path)
+
+        self.put(file_unique_id, path, len(data))
+
+    def _on_evict(self, key, value):
+        if not self.directory:
+            return
+
+        try:
+            os.remove(value)
+        except OSError as e:
+            logger.warning(f"Was unable to remove the evicted photo {value}.\n{e}")
+
+class TTLStore:
+    """
+    A thread-safe key-value store whose entries expire a fixed time after they were set,
+    optionally also bounded by a number of entries (the oldest ones are evicted first).
+    Expired entries are evicted lazily, whenever the store is accessed.
+    """
+    def __init__(self, ttl, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.hits = 0
+
+    def __len__(self):
+        with self._lock:
+            self._evict()
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for the key, or the default if there is none or it expired.
+        """
+        with self._lock:
+            self._evict()
+            if key not in self._entries:
+                return default
+
+            return self._entries[key][1]
+
+    def set(self, key, value):
+        """
+        Stores a value for the key, which expires ttl seconds from now.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._evict()
+
+    def add(self, key, value=True) -> bool:
+        """
+        Stores a value for the key only if there is none yet, which makes the store usable as a time-windowed seen-set.
+
+        :return: True if the value was stored, False if the key was already stored (and not yet expired)
+        """
+        with self._lock:
+            self._evict()
+            if key in self._entries:
+                self.hits += 1
+                return False
+
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._evict()
+            return True
+
+    def pop(self, key, default=None):
+        """
+        Removes the key from the store and returns its value, or the default if there is none or it expired.
+        """
+        with self._lock:
+            self._evict()
+            if key not in self._entries:
+                return default
+
+            return self._entries.pop(key)[1]
+
+    def _evict(self):
+        """
+        Evicts (under the lock) the expired entries, and the oldest ones beyond max_entries.
+        The entries are kept in the order they were set, which with a fixed ttl is also the order they expire in.
+        """
+        now = time.monotonic()
+
+        while self._entries:
+            key, (expires, value) = next(iter(self._entries.items()))
+            if expires > now and (not self.max_entries or len(self._entries) <= self.max_entries):
+                break
+
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            self._on_evict(key, value)
+
+    def _on_evict(self, key, value):
+        """
+        Called (under the lock) for every expired or overflowing entry, subclasses may release resources here.
+        """
+        pass
@@ -1,10 +1,15 @@
 from flask import Flask, request, jsonify
+import signal
+import atexit
+import sys
 import os
-from queue import Queue
-from bot import BotFactory
+from bot import BotFactory, media_groups
 from bot_utils import get_secret_value
-from process_results import ProcessResults
-from process_messages import ProcessMessages
+from caches import TTLStore
+from aws_clients import aws_clients
+from process_results import ResultsConsumer
+from process_messages import ProcessMessages, ShardedMessageQueue
+from queue_backends import get_queue_backend, SQLiteSeenSet
 
 app = Flask(__name__, static_url_path='')
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
@@ -13,18 +18,128 @@ REGION_NAME       = os.environ['AWS_DEFAULT_REGION']
 TELEGRAM_APP_URL  = os.environ['TELEGRAM_APP_URL']
 TELEGRAM_SECRET   = os.environ['TELEGRAM_SECRET']
 SUB_DOMAIN_SECRET = os.environ['SUB_DOMAIN_SECRET']
-
-response = get_secret_value(REGION_NAME, TELEGRAM_SECRET, 'TELEGRAM_TOKEN')
-if int(response[1]) != 200:
-    raise ValueError(response[0])
-
-TELEGRAM_TOKEN = response[0]
-
-response = get_secret_value(REGION_NAME, SUB_DOMAIN_SECRET)
-if int(response[1]) != 200:
-    raise ValueError(response[0])
-
-DOMAIN_CERTIFICATE = response[0]
+# The number of message worker threads, the messages are sharded between them by chat
+MESSAGE_WORKERS   = int(os.getenv('MESSAGE_WORKERS', '4'))
+# The number of message worker threads for cheap messages e.g. text replies, so they don't wait behind the image jobs
+CHEAP_MESSAGE_WORKERS = int(os.getenv('CHEAP_MESSAGE_WORKERS', '1'))
+# The number of message worker threads for predictions, which mostly wait on S3 and SQS
+IO_MESSAGE_WORKERS    = int(os.getenv('IO_MESSAGE_WORKERS', '1'))
+# The number of threads polling the results queue, scaled between these with the queue's backlog (a poller per RESULT_BACKLOG_PER_POLLER results)
+RESULT_POLLERS_MIN        = int(os.getenv('RESULT_POLLERS_MIN', '1'))
+RESULT_POLLERS_MAX        = int(os.getenv('RESULT_POLLERS_MAX', '4'))
+RESULT_BACKLOG_PER_POLLER = int(os.getenv('RESULT_BACKLOG_PER_POLLER', '50'))
+RESULT_SCALE_INTERVAL     = float(os.getenv('RESULT_SCALE_INTERVAL', '30'))
+# The number of threads handling the results received by all the pollers
+RESULT_HANDLER_THREADS    = int(os.getenv('RESULT_HANDLER_THREADS', '8'))
+# The maximum number of messages waiting to be handled, beyond it the webhook asks Telegram to retry later (0 - unbounded)
+MESSAGE_QUEUE_MAX_SIZE       = int(os.getenv('MESSAGE_QUEUE_MAX_SIZE', '1000'))
+# Between these watermarks plain text messages are dropped to make room for the images (default - 80% and 40% of the maximum)
+MESSAGE_QUEUE_HIGH_WATERMARK = int(os.getenv('MESSAGE_QUEUE_HIGH_WATERMARK', '0')) or None
+MESSAGE_QUEUE_LOW_WATERMARK  = int(os.getenv('MESSAGE_QUEUE_LOW_WATERMARK', '0')) or None
+MESSAGE_QUEUE_RETRY_AFTER    = os.getenv('MESSAGE_QUEUE_RETRY_AFTER', '5')
+# Either "memory" (default) or "sqlite", which journals the messages so the ones not handled yet survive a restart
+MESSAGE_QUEUE_BACKEND        = os.getenv('MESSAGE_QUEUE_BACKEND', 'memory')
+MESSAGE_QUEUE_DB             = os.getenv('MESSAGE_QUEUE_DB', 'data/messages.db')
+MESSAGE_QUEUE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_QUEUE_FLUSH_INTERVAL', '0.05'))
+MESSAGE_QUEUE_VISIBILITY     = float(os.getenv('MESSAGE_QUEUE_VISIBILITY_TIMEOUT', '300'))
+# Updates Telegram delivers again within this many seconds are ignored
+UPDATE_DEDUP_SECONDS     = float(os.getenv('UPDATE_DEDUP_SECONDS', '600'))
+UPDATE_DEDUP_MAX_ENTRIES = int(os.getenv('UPDATE_DEDUP_MAX_ENTRIES', '100000'))
+
+# Fetched by init_app()
+TELEGRAM_TOKEN     = None
+DOMAIN_CERTIFICATE = None
+
+# The updates seen lately, so the ones Telegram re-delivers (e.g. when the webhook answered slowly) are handled only once.
+# Replaced by create_seen_updates() on startup
+seen_updates = TTLStore(UPDATE_DEDUP_SECONDS, UPDATE_DEDUP_MAX_ENTRIES)
+
+# Created on startup, either by the __main__ block below or by the processes of serve.py
+message_queue = None
+results_consumer = None
+
+def create_queue_backend():
+    """
+    Creates the message queue backend chosen by MESSAGE_QUEUE_BACKEND
+    """
+    if MESSAGE_QUEUE_BACKEND == "sqlite":
+        return get_queue_backend("sqlite", MESSAGE_QUEUE_DB, flush_interval=MESSAGE_QUEUE_FLUSH_INTERVAL, visibility_timeout=MESSAGE_QUEUE_VISIBILITY)
+
+    return get_queue_backend(MESSAGE_QUEUE_BACKEND)
+
+def create_message_queue(ingress_only=False):
+    """
+    Creates the message queue, with a queue per message worker.
+    :param ingress_only: Only append the messages to the backend, for the worker processes sharing it to claim
+    """
+    return ShardedMessageQueue(MESSAGE_WORKERS, MESSAGE_QUEUE_MAX_SIZE, MESSAGE_QUEUE_HIGH_WATERMARK, MESSAGE_QUEUE_LOW_WATERMARK,
+                               CHEAP_MESSAGE_WORKERS, create_queue_backend(), ingress_only, IO_MESSAGE_WORKERS)
+
+def create_seen_updates():
+    """
+    Creates the store of the updates seen lately. With the sqlite backend it's kept in the backend's database,
+    so the webhook processes sharing it also share the updates they've seen.
+    """
+    if MESSAGE_QUEUE_BACKEND == "sqlite":
+        return SQLiteSeenSet(MESSAGE_QUEUE_DB, UPDATE_DEDUP_SECONDS, UPDATE_DEDUP_MAX_ENTRIES, MESSAGE_QUEUE_FLUSH_INTERVAL)
+
+    return TTLStore(UPDATE_DEDUP_SECONDS, UPDATE_DEDUP_MAX_ENTRIES)
+
+def close_queues():
+    """
+    Commits the writes the message queue and the seen updates still hold in memory, when the process stops gracefully
+    """
+    if message_queue:
+        message_queue.backend.close()
+    if isinstance(seen_updates, SQLiteSeenSet):
+        seen_updates.close()
+
+def init_app():
+    """
+    Fetches the secrets of the service and registers the webhook route, which is named after the Telegram token.
+    It isn't done on import, as the image worker processes import the main module again every time one of them starts.
+    """
+    global TELEGRAM_TOKEN, DOMAIN_CERTIFICATE
+
+    if TELEGRAM_TOKEN:
+        return
+
+    response = get_secret_value(REGION_NAME, TELEGRAM_SECRET, 'TELEGRAM_TOKEN')
+    if int(response[1]) != 200:
+        raise ValueError(response[0])
+
+    TELEGRAM_TOKEN = response[0]
+
+    response = get_secret_value(REGION_NAME, SUB_DOMAIN_SECRET)
+    if int(response[1]) != 200:
+        raise ValueError(response[0])
+
+    DOMAIN_CERTIFICATE = response[0]
+
+    app.add_url_rule(f'/{TELEGRAM_TOKEN}/', view_func=webhook, methods=['POST'])
+
+def start_message_workers(bot_factory, message_queue):
+    """
+    Starts a message worker thread per queue of the message queue
+    """
+    # A media group is concatenated by a message worker of its chat, after every photo of it already queued
+    media_groups.on_due = lambda chat_id, media_group_id: message_queue.put_internal(media_groups.flush_message(chat_id, media_group_id))
+
+    for shard in message_queue.shards:
+        messages_queue_thread = ProcessMessages(app, bot_factory, shard)
+        messages_queue_thread.daemon = True
+        messages_queue_thread.start()
+
+def start_result_workers(bot_factory):
+    """
+    Starts consuming the results queue, with as many pollers as its backlog calls for
+    """
+    global results_consumer
+
+    results_consumer = ResultsConsumer(app, bot_factory, RESULT_POLLERS_MIN, RESULT_POLLERS_MAX, RESULT_HANDLER_THREADS,
+                                       RESULT_BACKLOG_PER_POLLER, RESULT_SCALE_INTERVAL)
+    results_consumer.daemon = True
+    results_consumer.start()
 
 @app.route('/', methods=['GET'])
 def index():
@@ -38,7 +153,55 @@ def health():
 def ready():
     return jsonify({"status": "ready", "message": "Service is ready!"}), 200
 
-@app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
+@app.route('/queues', methods=['GET'])
+def queues():
+    stats = dict(message_queue.stats(), duplicates=seen_updates.hits, aws=aws_clients.stats())
+
+    # The results are consumed in this process only when it isn't run by serve.py
+    if results_consumer:
+        stats["results"] = results_consumer.stats()
+
+    return jsonify(stats), 200
+
+def update_keys(req, msg):
+    """
+    The keys which identify the update: its update_id, and the message it carries (including the edit date of an edited message)
+    """
+    keys = []
+    if "update_id" in req:
+        keys.append(("update", req["update_id"]))
+    if "message_id" in msg:
+        keys.append(("message", msg.get("chat", {}).get("id"), msg["message_id"], msg.get("edit_date")))
+
+    return keys
+
+def enqueue(req, msg, dedup=True):
+    """
+    Queues the message for the message workers, unless it's a re-delivery of an update already seen,
+    shedding load when the queue is too full
+    :param dedup: Check whether the update was already seen
+    """
+    keys = update_keys(req, msg) if dedup else []
+
+    # Every key is recorded, so a re-delivery is caught by whichever key it repeats
+    if not all([seen_updates.add(key) for key in keys]):
+        return 'Duplicate', 200
+
+    status = message_queue.put(msg)
+
+    if status == ShardedMessageQueue.REJECTED:
+        # Not queued, so the update must not count as seen when Telegram retries it
+        for key in keys:
+            seen_updates.pop(key)
+
+        # Telegram retries the update later when the webhook doesn't answer with a success
+        return 'Too busy, please retry', 503, {'Retry-After': MESSAGE_QUEUE_RETRY_AFTER}
+
+    if status == ShardedMessageQueue.DROPPED:
+        return 'Dropped', 200
+
+    return 'Ok', 200
+
 def webhook():
     req = request.get_json()
     if "message" in req:
@@ -48,9 +211,7 @@ def webhook():
     else:
         return 'No message', 400
 
-    message_queue.put(msg)
-
-    return 'Ok', 200
+    return enqueue(req, msg)
 
 @app.route(f'/loadTest/', methods=['POST'])
 def load_test():
@@ -62,23 +223,26 @@ def load_test():
     else:
         return 'No message', 400
 
-    message_queue.put(msg)
-
-    return 'Ok', 200
+    # A load test sends the same update over and over, which must all be handled rather than dropped as re-deliveries
+    return enqueue(req, msg, dedup=False)
 
 if __name__ == "__main__":
+    init_app()
     bot_factory = BotFactory(TELEGRAM_TOKEN, TELEGRAM_APP_URL, DOMAIN_CERTIFICATE)
 
-    # Create a message queue
-    message_queue = Queue()
+    # Runs everything in this process, with the Flask development server. For production use serve.py
+    # Create a message queue per message worker
+    message_queue = create_message_queue()
+    seen_updates = create_seen_updates()
+    # The development server doesn't handle SIGTERM, exiting on it lets the queues commit what they still hold
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(close_queues)
+    # The messages accepted but not handled before the last shutdown are handled first
+    message_queue.replay()
+    message_queue.watch_visibility()
 
     # Start the results and messages threads when the application starts
-    results_queue_thread = ProcessResults(app, bot_factory)
-    results_queue_thread.daemon = True
-    results_queue_thread.start()
-
-    messages_queue_thread = ProcessMessages(app, bot_factory, message_queue)
-    messages_queue_thread.daemon = True
-    messages_queue_thread.start()
+    start_result_workers(bot_factory)
+    start_message_workers(bot_factory, message_queue)
 
     app.run(host='0.0.0.0', port=8443)
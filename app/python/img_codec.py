@@ -0,0 +1,200 @@
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import io
+import os
+
+# Quality of the JPEG images written (1-95)
+JPEG_QUALITY       = int(os.getenv("IMG_JPEG_QUALITY", "90"))
+# zlib compression level of the PNG images written (0-9), the lower the faster
+PNG_COMPRESS_LEVEL = int(os.getenv("IMG_PNG_COMPRESS_LEVEL", "3"))
+# Number of rows converted to 8-bit at a time when encoding
+ENCODE_BAND_ROWS   = int(os.getenv("IMG_ENCODE_BAND_ROWS", "512"))
+
+_pil_image = None
+
+def _get_pil():
+    """
+    Imports Pillow on first use, so importing this module stays cheap.
+
+    :return: the PIL.Image module, or None if Pillow isn't installed
+    """
+    global _pil_image
+
+    if _pil_image is None:
+        try:
+            from PIL import Image
+            _pil_image = Image
+        except ImportError:
+            logger.warning("Pillow isn't installed, images will be decoded and encoded with matplotlib.")
+            _pil_image = False
+
+    return _pil_image or None
+
+def _open(source):
+    """
+    Accepts a path or the bytes of an image file.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+
+    return source
+
+def _matplotlib_decode(source) -> np.ndarray:
+    """
+    Decodes with matplotlib (only imported when this fallback is needed), always returning 8-bit values.
+    """
+    from matplotlib.image import imread
+
+    decoded = imread(_open(source))
+
+    if decoded.dtype != np.uint8:
+        # matplotlib returns PNG images as floats between 0 and 1
+        decoded = np.rint(decoded * 255).astype(np.uint8)
+
+    return decoded
+
+def downscale_factor(width, height, max_pixels) -> int:
+    """
+    :return: int - the largest whole factor both sides can be divided by while keeping at least max_pixels pixels (1 - no downscaling)
+    """
+    if not max_pixels or width * height <= max_pixels:
+        return 1
+
+    return max(1, int((width * height / max_pixels) ** 0.5))
+
+def _pil_decode(source, mode, max_pixels):
+    """
+    Decodes with Pillow, downscaling during the decoding when the image is larger than needed.
+    """
+    Image = _get_pil()
+
+    with Image.open(_open(source)) as img:
+        if max_pixels:
+            factor = downscale_factor(img.width, img.height, max_pixels)
+
+            if factor > 1:
+                # For JPEG images this makes the decoder itself scale down by up to 8, almost for free
+                img.draft(mode, (img.width // factor, img.height // factor))
+
+                # Whatever is left (or any factor for other formats) is done by averaging blocks of pixels,
+                # after the conversion since palette, 1-bit and 16-bit images can't be averaged as they are
+                factor = downscale_factor(img.width, img.height, max_pixels)
+                if factor > 1:
+                    return np.array(img.convert(mode).reduce(factor))
+
+        return np.array(img.convert(mode))
+
+def decode_gray(source, max_pixels=None) -> np.ndarray:
+    """
+    Decodes a JPEG or PNG image straight to 8-bit grayscale.
+
+    :param source: The path of the image file, or its bytes
+    :param max_pixels: When set, an image with more pixels is downscaled by a whole factor while decoding, down to about this many
+    :return: 2D uint8 array
+    """
+    if _get_pil():
+        return _pil_decode(source, "L", max_pixels)
+
+    rgb = _matplotlib_decode(source)
+    factor = downscale_factor(rgb.shape[1], rgb.shape[0], max_pixels)
+    rgb = rgb[::factor, ::factor]
+
+    if rgb.ndim == 2:
+        return rgb
+
+    gray = np.float32(0.2989) * rgb[:, :, 0] + np.float32(0.5870) * rgb[:, :, 1] + np.float32(0.1140) * rgb[:, :, 2]
+    return np.rint(gray).astype(np.uint8)
+
+def decode_rgb(source, max_pixels=None) -> np.ndarray:
+    """
+    Decodes a JPEG or PNG image to 8-bit RGB.
+
+    :param source: The path of the image file, or its bytes
+    :param max_pixels: When set, an image with more pixels is downscaled by a whole factor while decoding, down to about this many
+    :return: 3D uint8 array of shape (height, width, 3)
+    """
+    if _get_pil():
+        return _pil_decode(source, "RGB", max_pixels)
+
+    rgb = _matplotlib_decode(source)
+    factor = downscale_factor(rgb.shape[1], rgb.shape[0], max_pixels)
+    rgb = rgb[::factor, ::factor]
+
+    if rgb.ndim == 2:
+        return np.repeat(rgb[:, :, np.newaxis], 3, axis=2)
+
+    return rgb[:, :, :3]
+
+def to_uint8(data) -> np.ndarray:
+    """
+    Scales a grayscale matrix to 8-bit the same way matplotlib's imsave(cmap='gray') does:
+    the lowest value becomes black, the highest white. Done band by band to bound the scratch memory.
+
+    :param data: 2D array
+    :return: 2D uint8 array
+    """
+    low, high = data.min(), data.max()
+    result = np.empty(data.shape, dtype=np.uint8)
+
+    if high == low:
+        result[...] = 0
+        return result
+
+    scale = 256 / (float(high) - float(low))
+
+    for start in range(0, data.shape[0], ENCODE_BAND_ROWS):
+        band = (data[start:start + ENCODE_BAND_ROWS] - low) * scale
+        np.clip(band, 0, 255, out=band)
+        result[start:start + ENCODE_BAND_ROWS] = band
+
+    return result
+
+def encode(data, format="png") -> bytes:
+    """
+    Encodes a grayscale matrix as a PNG or JPEG image.
+
+    :param data: 2D array
+    :param format: Either "png" or "jpeg"
+    :return: bytes - the encoded image file
+    """
+    buffer = io.BytesIO()
+    encode_to(data, buffer, format)
+    return buffer.getvalue()
+
+def encode_to(data, target, format="png") -> None:
+    """
+    Encodes a grayscale matrix as a PNG or JPEG image into a file.
+
+    :param data: 2D array
+    :param target: The path of the file or a writable file object
+    :param format: Either "png" or "jpeg"
+    :return None:
+    """
+    format = format.lower().lstrip(".")
+    if format == "jpg":
+        format = "jpeg"
+
+    if format not in ["png", "jpeg"]:
+        raise ValueError("Images may only be encoded as 'png' or 'jpeg'.")
+
+    Image = _get_pil()
+
+    if not Image:
+        from matplotlib.image import imsave
+        imsave(target, data, cmap='gray', format=format)
+        return
+
+    img = Image.fromarray(to_uint8(data), mode="L")
+
+    if format == "jpeg":
+        img.save(target, format="JPEG", quality=JPEG_QUALITY, optimize=False)
+    else:
+        img.save(target, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+def format_from_path(path) -> str:
+    """
+    :param path: The path of an image file
+    :return: str - "jpeg" for .jpg/.jpeg files, "png" for anything else
+    """
+    return "jpeg" if Path(path).suffix.lower() in [".jpg", ".jpeg"] else "png"
@@ -0,0 +1,89 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from loguru import logger
+from img_proc import Img, pool_context
+import threading
+import os
+
+# "inline" runs the image jobs on the calling thread, "process" sends them to a pool of worker processes
+IMG_EXECUTOR                 = os.getenv("IMG_EXECUTOR", "inline")
+# Number of worker processes in the pool (default - the number of CPUs)
+IMG_POOL_WORKERS             = int(os.getenv("IMG_POOL_WORKERS", "0")) or None
+# Each worker process is replaced after running this many jobs, to limit memory creep (0 - never)
+IMG_POOL_MAX_TASKS_PER_CHILD = int(os.getenv("IMG_POOL_MAX_TASKS_PER_CHILD", "50")) or None
+
+IMAGE_OPERATIONS = ["blur", "contour", "rotate", "salt_n_pepper", "segment"]
+
+def run_image_job(image, operations, format="png", max_pixels=None) -> bytes:
+    """
+    Decodes an image, applies the operations to it and encodes the result, all in memory.
+    This is the unit of work sent to the image executor, so it only takes and returns picklable values.
+
+    :param image: The bytes (or path) of the image file
+    :param operations: list of (operation name, keyword arguments dict) tuples e.g. [("blur", {"blur_level": "10"})]
+    :param format: The format of the result, either "png" or "jpeg"
+    :param max_pixels: When set, a larger image is downscaled while it's decoded, down to about this many pixels
+    :return: bytes - the encoded processed image
+    """
+    img = Img(image, max_pixels=max_pixels)
+
+    for name, kwargs in operations:
+        if name not in IMAGE_OPERATIONS:
+            raise ValueError(f"Unknown image operation '{name}'.")
+
+        getattr(img, name)(**kwargs)
+
+    return img.encode(format)
+
+def run_concat_job(images, format="png", **kwargs) -> bytes:
+    """
+    Decodes the images, concatenates them all in a single pass and encodes the result, all in memory.
+
+    :param images: list of the bytes (or paths) of the image files, in order
+    :param format: The format of the result, either "png" or "jpeg"
+    :param kwargs: the direction and/or sides arguments of Img.concat
+    :return: bytes - the encoded concatenated image
+    """
+    images = [Img(image) for image in images]
+    images[0].concat(images[1:], **kwargs)
+
+    return images[0].encode(format)
+
+class InlineExecutor(Executor):
+    """
+    An executor which runs every job right away on the calling thread.
+    """
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+        return future
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_image_executor() -> Executor:
+    """
+    Returns the process-wide executor for image jobs, creating it on first use according to IMG_EXECUTOR.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            if IMG_EXECUTOR == "process":
+                # Recycling workers (max_tasks_per_child) isn't supported with the "fork" start method
+                _executor = ProcessPoolExecutor(
+                    max_workers=IMG_POOL_WORKERS,
+                    mp_context=pool_context(),
+                    max_tasks_per_child=IMG_POOL_MAX_TASKS_PER_CHILD
+                )
+                logger.info(f"Image jobs will run on a process pool of {_executor._max_workers} workers, recycled every {IMG_POOL_MAX_TASKS_PER_CHILD} jobs.")
+            elif IMG_EXECUTOR == "inline":
+                _executor = InlineExecutor()
+            else:
+                raise ValueError("IMG_EXECUTOR may only be 'inline' or 'process'.")
+
+        return _executor
@@ -1,56 +1,746 @@
 from pathlib import Path
-from matplotlib.image import imread, imsave
-import random
-
-def rgb2gray(rgb):
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from img_codec import decode_gray, decode_rgb, encode, encode_to, format_from_path
+import numpy as np
+import multiprocessing
+import threading
+import tempfile
+import sys
+import os
+
+# "compact" stores the image as 8-bit grayscale (uint8), "float64" keeps the legacy full precision conversion from RGB
+DTYPE_POLICY = os.getenv("IMG_DTYPE_POLICY", "compact")
+# Number of rows processed at a time by the in place operations, bounds their scratch memory
+INPLACE_BAND_ROWS = int(os.getenv("IMG_INPLACE_BAND_ROWS", "256"))
+# Images with at least this many pixels are processed in tiled mode, 0 disables switching to it automatically
+TILED_MIN_PIXELS = int(os.getenv("IMG_TILED_MIN_PIXELS", "0"))
+# Number of rows held in memory at a time by every operation in tiled mode
+TILED_BAND_ROWS = int(os.getenv("IMG_TILED_BAND_ROWS", "512"))
+# Where the memory-mapped scratch files of tiled mode are created (default the system's temp directory)
+SCRATCH_DIR = os.getenv("IMG_SCRATCH_DIR", None)
+# Number of processes a single blur or segment is split across, 0 or 1 disables splitting
+PARALLEL_WORKERS = int(os.getenv("IMG_PARALLEL_WORKERS", "0"))
+# Images smaller than this many pixels aren't worth splitting
+PARALLEL_MIN_PIXELS = int(os.getenv("IMG_PARALLEL_MIN_PIXELS", "4000000"))
+
+def rgb2gray(rgb, dtype=np.float64):
     r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
-    gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
+    gray = dtype(0.2989) * r + dtype(0.5870) * g + dtype(0.1140) * b
     return gray
 
+def integral_image(mat):
+    """
+    Builds the summed-area table of a 2D matrix, padded with a leading row and column of zeros,
+    so that the sum of any window is available with 4 lookups.
+
+    :param mat: 2D array
+    :return: 2D array of shape (height + 1, width + 1)
+    """
+    # Integer images are summed exactly, only images which are already floating point are summed in float64
+    acc_dtype = np.int64 if np.issubdtype(mat.dtype, np.integer) else np.float64
+
+    table = np.zeros((mat.shape[0] + 1, mat.shape[1] + 1), dtype=acc_dtype)
+    np.cumsum(mat, axis=0, dtype=acc_dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+def ordered_window_sums(mat, window, rows=None, cols=None):
+    """
+    Sums windows in the order the original list based blur did: every row of the window left to right, then the rows top to bottom,
+    so that floating point sums come out bit for bit the same as they used to.
+
+    :param mat: 2D array
+    :param window: The size of the window's side
+    :param rows: The top rows of the windows to sum (default - every "valid" window)
+    :param cols: The left columns of the windows to sum, along with rows
+    :return: 2D array of shape (height - window + 1, width - window + 1), or 1D array of the windows at rows and cols
+    """
+    acc_dtype = np.int64 if np.issubdtype(mat.dtype, np.integer) else np.float64
+
+    if rows is None:
+        height, width = mat.shape[0] - window + 1, mat.shape[1] - window + 1
+        shape = (height, width)
+        pixels = lambda i, j: mat[i:i + height, j:j + width]
+    else:
+        shape = rows.shape
+        pixels = lambda i, j: mat[rows + i, cols + j]
+
+    sums = np.zeros(shape, dtype=acc_dtype)
+    row_sums = np.empty(shape, dtype=acc_dtype)
+
+    for i in range(window):
+        row_sums[...] = 0
+        for j in range(window):
+            row_sums += pixels(i, j)
+        sums += row_sums
+
+    return sums
+
+def window_sums(mat, window, mode="integral"):
+    """
+    Sums every "valid" window x window window of a 2D matrix.
+
+    :param mat: 2D array
+    :param window: The size of the window's side
+    :param mode: Either "integral" which reads the sums off a summed-area table, or "direct" which sums every window explicitly
+    :return: 2D array of shape (height - window + 1, width - window + 1)
+    """
+    if mode != "integral":
+        return ordered_window_sums(mat, window)
+
+    table = integral_image(mat)
+    sums = table[window:, window:] - table[:-window, window:]
+    sums -= table[window:, :-window]
+    sums += table[:-window, :-window]
+
+    if sums.dtype.kind == "f" and sums.size:
+        # Floating point sums off the table carry rounding errors, which only matter to the blur where a sum is so close
+        # to a multiple of the window's size that it may be floored (or thresholded) the other way. Those few are summed again exactly
+        filter_sum = window ** 2
+        tolerance = (4 * (mat.shape[0] + mat.shape[1]) + filter_sum) * np.finfo(np.float64).eps * float(np.abs(mat).sum())
+        quotients = sums / filter_sum
+        rows, cols = np.nonzero(np.abs(quotients - np.rint(quotients)) * filter_sum <= tolerance)
+        sums[rows, cols] = ordered_window_sums(mat, window, rows, cols)
+
+    return sums
+
+def blur_band(data, result, start, stop, blur_level, mode, threshold=False):
+    """
+    Blurs the output rows [start, stop) of an image into result.
+
+    :param data: 2D array - the whole input image (only the rows the band needs are read)
+    :param result: 2D array - the whole output image
+    :param start: The first output row of the band
+    :param stop: The output row after the last one of the band
+    :param blur_level: The size of the blur window's side
+    :param mode: Either "integral" or "direct", see window_sums
+    :param threshold: Whether to segment the blurred pixels in the same pass
+    :return: 2D array - the band's window sums, a scratch buffer
+    """
+    filter_sum = blur_level ** 2
+
+    # Each band of output rows needs blur_level - 1 halo rows of input below it
+    sums = window_sums(data[start:stop + blur_level - 1], blur_level, mode)
+
+    if threshold:
+        # floor(sum / filter_sum) > 100 is the same as sum >= 101 * filter_sum, so the division is skipped
+        band = result[start:stop]
+        band[...] = sums >= 101 * filter_sum
+        band *= 255
+    else:
+        sums //= filter_sum
+        result[start:stop] = sums
+
+    return sums
+
+def segment_band(band):
+    """
+    Segments a band of rows in place.
+
+    :param band: 2D array
+    :return: 2D array - the mask, a scratch buffer
+    """
+    mask = band > 100
+    band[...] = mask
+    band *= 255
+    return mask
+
+def _attach(shared):
+    """
+    Attaches to a matrix in shared memory.
+
+    :param shared: tuple of (shared memory name, shape, dtype string)
+    :return: tuple of (SharedMemory, 2D array backed by it)
+    """
+    name, shape, dtype = shared
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _run_shared_band(operation, source, target, start, stop, params):
+    """
+    Runs one band of an operation in a worker process, reading and writing matrices in shared memory.
+    Only the names and shapes of the matrices are pickled, never their pixels.
+    """
+    source_shm, data = _attach(source)
+    target_shm, result = _attach(target) if target else (None, data)
+
+    try:
+        if operation == "blur":
+            blur_band(data, result, start, stop, **params)
+        elif operation == "segment":
+            segment_band(result[start:stop])
+    finally:
+        # The arrays have to be released before the shared memory can be closed
+        del data, result
+        source_shm.close()
+        if target_shm:
+            target_shm.close()
+
+_band_pool = None
+_band_pool_lock = threading.Lock()
+
+def pool_context():
+    """
+    The start method of the image process pools. With "forkserver" a server process imports the main module and the image modules once,
+    and every worker (including one replacing a recycled worker) is forked from it with all of them already imported.
+    Falls back to "spawn" where it isn't available.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+
+    preload = ["img_proc", "img_codec"]
+
+    # The workers still run the main module again, but find everything it imports already imported. It's preloaded by its module name,
+    # as Python 3.11 ignores "__main__" in the preload list
+    main_path = getattr(sys.modules["__main__"], "__file__", None)
+    if main_path:
+        preload.insert(0, Path(main_path).stem)
+
+    context = multiprocessing.get_context("forkserver")
+    # Only takes effect before the server is started, i.e. by whichever pool is created first
+    context.set_forkserver_preload(preload)
+    return context
+
+def _get_band_pool(workers):
+    """
+    Returns the process pool which runs the bands of split operations, creating it on first use.
+
+    :param workers: The number of workers the caller would like, used only if IMG_PARALLEL_WORKERS isn't set
+    """
+    global _band_pool
+
+    with _band_pool_lock:
+        if _band_pool is None:
+            _band_pool = ProcessPoolExecutor(max_workers=PARALLEL_WORKERS or workers, mp_context=pool_context())
+
+        return _band_pool
+
+def salt_n_pepper_noise(shape, noise_level, seed=None):
+    """
+    Draws the positions and values of salt and pepper noise for a matrix of the given shape in one batched draw.
+
+    Each draw encodes both the flat pixel index (upper bits) and the salt/pepper choice (lowest bit),
+    so a single call to the generator yields everything needed. The same pixel may be picked more than once.
+
+    :param shape: tuple of (height, width)
+    :param noise_level: A float representing the proportion of the pixels to be affected by noise.
+    :param seed: None, an int seed or a numpy Generator, allows reproducible noise
+    :return: tuple of (flat pixel indices, values of either 255 or 0)
+    """
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+    total_pixels = shape[0] * shape[1]
+    affected_pixels = int(total_pixels * noise_level)
+
+    draws = rng.integers(0, 2 * total_pixels, size=affected_pixels, dtype=np.int64)
+
+    indices = draws >> 1
+    values = (draws & 1).astype(np.uint8) * np.uint8(255)
+    return indices, values
+
+
+def optimize_plan(plan):
+    """
+    Simplifies a list of pending image operations before anything is executed.
+
+    - Rotations are moved past segment operations (segmenting is per pixel, so the order doesn't matter)
+      and consecutive rotations are collapsed into a single one
+    - Rotations by a multiple of 360 degrees and repeated segment operations are dropped
+    - A segment operation is fused into the blur, contour or concat operation right before it,
+      so the threshold is applied in the same pass
+
+    :param plan: list of (operation name, parameters dict) tuples
+    :return: list of (operation name, parameters dict) tuples - the simplified plan
+    """
+    # First, move rotations after any segment operations which follow them
+    ordered = []
+    for name, params in plan:
+        if name == "segment":
+            position = len(ordered)
+            while position > 0 and ordered[position - 1][0] == "rotate":
+                position -= 1
+            ordered.insert(position, (name, params))
+        else:
+            ordered.append((name, params))
+
+    simplified = []
+    for name, params in ordered:
+        previous = simplified[-1] if simplified else None
+
+        if name == "rotate":
+            if previous and previous[0] == "rotate":
+                simplified[-1] = ("rotate", {"k": (previous[1]["k"] + params["k"]) % 4})
+            else:
+                simplified.append((name, dict(params)))
+
+            if simplified[-1][1]["k"] % 4 == 0:
+                simplified.pop()
+        elif name == "segment":
+            if previous and (previous[0] == "segment" or previous[1].get("threshold")):
+                # Already segmented, segmenting again changes nothing
+                continue
+
+            if previous and previous[0] in ["blur", "contour", "concat"]:
+                simplified[-1] = (previous[0], dict(previous[1], threshold=True))
+            else:
+                simplified.append((name, dict(params)))
+        else:
+            simplified.append((name, dict(params)))
+
+    return simplified
+
+
+def resident_nbytes(*arrays):
+    """
+    Sums the memory held by arrays, counting buffers shared between views only once and skipping memory-mapped files.
+
+    :param arrays: numpy arrays (or views)
+    :return: int - number of bytes
+    """
+    buffers = {}
+    for arr in arrays:
+        base = arr
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+
+        if not isinstance(base, np.memmap):
+            buffers[id(base)] = base.nbytes
+
+    return sum(buffers.values())
+
 
 class Img:
 
-    def __init__(self, path):
+    def __init__(self, path, dtype_policy=None, tiled=None, band_rows=None, workers=None, max_pixels=None):
+        """
+        The image is held as a 2D numpy array of grayscale values.
+        Operations are not executed right away, they are recorded into a plan which is simplified
+        and executed only once the data is needed (e.g. by save_img).
+        Use to_list() if the legacy list of lists representation is needed.
+
+        In tiled mode the image and the results of every operation live in memory-mapped scratch files
+        and the operations stream over bands of rows, so the memory they use depends on the band size and not the image size.
+        Decoding and encoding aren't streamed (Pillow needs the whole image), they still hold the image in memory once as 8-bit values,
+        which tiled mode keeps from being the float64 or int64 matrices the operations work on.
+
+        :param path: The path of the image file, or the image file's bytes to decode it from memory
+        :param dtype_policy: Either "compact" or "float64" (default taken from the IMG_DTYPE_POLICY environment variable)
+        :param tiled: Whether to use tiled mode (default - only for images of at least IMG_TILED_MIN_PIXELS pixels)
+        :param band_rows: The number of rows in a band in tiled mode (default taken from the IMG_TILED_BAND_ROWS environment variable)
+        :param workers: The number of processes blur and segment are split across, through shared memory
+                        (default taken from the IMG_PARALLEL_WORKERS environment variable, for images of at least IMG_PARALLEL_MIN_PIXELS pixels)
+        :param max_pixels: When set, a larger image is downscaled while it's decoded, down to about this many pixels
+        """
+        self.dtype_policy = dtype_policy or DTYPE_POLICY
+
+        if self.dtype_policy not in ["compact", "float64"]:
+            raise ValueError("The dtype policy may only be 'compact' or 'float64'.")
+
+        # An image decoded from memory has no path
+        self.path = None if isinstance(path, (bytes, bytearray, memoryview)) else Path(path)
+        self._plan = []
+        self._peak_nbytes = 0
+
+        # The compact policy decodes straight to 8-bit grayscale, the float64 one needs the RGB channels
+        decoded = decode_gray(path, max_pixels) if self.dtype_policy == "compact" else decode_rgb(path, max_pixels)
+        pixels = decoded.shape[0] * decoded.shape[1]
+        # Pillow's own copy of the pixels was alive while the array was made from it
+        self._account(decoded, extra_nbytes=decoded.nbytes)
+
+        if tiled is None:
+            tiled = TILED_MIN_PIXELS > 0 and pixels >= TILED_MIN_PIXELS
+
+        self.tiled = tiled
+        self.band_rows = max(1, int(band_rows or TILED_BAND_ROWS)) if tiled else None
+
+        if workers is None:
+            workers = PARALLEL_WORKERS if pixels >= PARALLEL_MIN_PIXELS else 0
+
+        # Tiled mode already bounds the memory by streaming, splitting the work would defeat it
+        self.workers = 0 if tiled else workers
+
+        self._data = self._to_storage(decoded)
+        self._account(self._data)
+
+    def _to_storage(self, decoded) -> np.ndarray:
+        """
+        Moves a decoded image into the storage of the image, band by band.
+        An 8-bit grayscale image is kept as is, an RGB one is converted to float64 grayscale.
+        """
+        if decoded.ndim == 2 and not self.tiled:
+            return decoded
+
+        data = self._new_buffer(decoded.shape[:2], decoded.dtype if decoded.ndim == 2 else np.float64)
+
+        for start, stop in self._bands(decoded.shape[0]):
+            if decoded.ndim == 2:
+                data[start:stop] = decoded[start:stop]
+                self._account(data, decoded)
+            else:
+                gray = rgb2gray(decoded[start:stop])
+                data[start:stop] = gray
+                self._account(data, decoded, gray)
+
+        return data
+
+    def _new_buffer(self, shape, dtype) -> np.ndarray:
+        """
+        Allocates an uninitialized matrix, backed by an anonymous memory-mapped scratch file in tiled mode.
+        The scratch file is removed from the disk right away and its space is released once the matrix is no longer referenced.
+        """
+        if not self.tiled:
+            return np.empty(shape, dtype=dtype)
+
+        with tempfile.TemporaryFile(prefix="img_", dir=SCRATCH_DIR) as scratch:
+            return np.memmap(scratch, dtype=dtype, mode="w+", shape=shape)
+
+    def _bands(self, height, band_rows=None):
+        """
+        Splits a number of rows into consecutive bands.
+
+        :param height: The total number of rows
+        :param band_rows: The number of rows in a band (default - the tiled mode band size, or a single band of all the rows)
+        :return: generator of (start, stop) tuples
+        """
+        band_rows = band_rows or self.band_rows or max(height, 1)
+
+        for start in range(0, height, band_rows):
+            yield start, min(start + band_rows, height)
+
+    @property
+    def data(self) -> np.ndarray:
         """
-        Do not change the constructor implementation
+        The image matrix, with all the pending operations applied.
         """
-        self.path = Path(path)
-        self.data = rgb2gray(imread(path)).tolist()
+        self._execute()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._plan = []
+        self._data = np.asarray(value)
+        self._account(self._data)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The number of bytes currently held in memory by the image, including the images waiting in the plan to be concatenated.
+        Buffers backed by tiled mode scratch files aren't counted.
+        """
+        return resident_nbytes(self._data, *[other for name, params in self._plan if name == "concat" for other in params["others"]])
+
+    @property
+    def peak_nbytes(self) -> int:
+        """
+        The highest number of bytes held in memory at once by the image so far, including the scratch buffers of its operations
+        and the buffers of decoding and encoding it.
+        """
+        return max(self._peak_nbytes, self.nbytes)
+
+    def _account(self, *arrays, extra_nbytes=0) -> None:
+        """
+        Records the combined size of arrays which are alive at the same time, counting shared buffers only once.
+
+        :param arrays: numpy arrays (or views)
+        :param extra_nbytes: The size of buffers alive at the same time which aren't numpy arrays, e.g. Pillow's
+        :return None: updates the class property _peak_nbytes
+        """
+        self._peak_nbytes = max(self._peak_nbytes, resident_nbytes(*arrays) + extra_nbytes + resident_nbytes(
+            *[other for name, params in self._plan if name == "concat" for other in params["others"]]))
+
+    @property
+    def shape(self) -> tuple:
+        """
+        The (height, width) the image will have once all the pending operations are applied.
+        Computed without executing anything.
+        """
+        height, width = self._data.shape
+
+        for name, params in self._plan:
+            if name == "rotate" and params["k"] % 2:
+                height, width = width, height
+            elif name == "blur":
+                height, width = height - params["blur_level"] + 1, width - params["blur_level"] + 1
+            elif name == "contour":
+                width = width - 1
+            elif name == "concat":
+                if params["direction"] == "horizontal":
+                    width = width + sum(other.shape[1] for other in params["others"])
+                else:
+                    height = height + sum(other.shape[0] for other in params["others"])
+
+        return height, width
+
+    def to_list(self) -> list:
+        """
+        Exports the image matrix as a list of lists, as it used to be stored before the move to numpy.
+
+        :return: list of lists - the image matrix
+        """
+        return self.data.tolist()
 
     def save_img(self) -> Path:
         """
-        Do not change the below implementation
+        Executes the pending operations and saves the image next to the original one with a '_filtered' suffix.
         """
+        if self.path is None:
+            raise ValueError("An image decoded from memory has no path to be saved next to, use encode() instead.")
+
         new_path = self.path.with_name(self.path.stem + '_filtered' + self.path.suffix)
-        imsave(new_path, self.data, cmap='gray')
+        data = self.data
+        self._account_encoding(data)
+        encode_to(data, new_path, format_from_path(new_path))
         return new_path
 
-    def blur(self, blur_level=16) -> None:
+    def encode(self, format=None) -> bytes:
+        """
+        Executes the pending operations and encodes the image in memory, without touching the disk.
+
+        :param format: Either "png" or "jpeg" (default - the format of the original file's extension, or "png")
+        :return: bytes - the encoded image file
+        """
+        if format is None:
+            format = format_from_path(self.path) if self.path else "png"
+
+        data = self.data
+        self._account_encoding(data)
+        return encode(data, format)
+
+    def _account_encoding(self, data) -> None:
+        """
+        Records the memory of encoding the image: it's converted to a whole 8-bit matrix first, which Pillow encodes in place
+        """
+        self._account(data, extra_nbytes=data.shape[0] * data.shape[1])
+
+    def _execute(self) -> None:
+        """
+        Simplifies the pending plan and runs it, one pass per remaining operation.
+
+        :return None: sets the class property _data
+        """
+        if not self._plan:
+            return
+
+        plan = optimize_plan(self._plan)
+        self._plan = []
+
+        data = self._data
+        for name, params in plan:
+            data = getattr(self, f"_apply_{name}")(data, **params)
+            self._data = data
+
+        self._account(self._data)
+
+    def _run_parallel(self, operation, data, result_shape=None, **params) -> np.ndarray:
+        """
+        Splits an operation into row bands which are processed by the band pool's workers in parallel.
+        The input (and output) are placed in shared memory so the workers read and write them directly,
+        the output is then copied back out and the shared memory released.
+
+        :param operation: Either "blur" or "segment" (which runs in place, without a separate output)
+        :param data: 2D array - the input
+        :param result_shape: The shape of the output, for operations which don't run in place
+        :param params: The keyword arguments of the operation's band function
+        :return: 2D array - the result
+        """
+        blocks = []
+
+        try:
+            source = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+            blocks.append(source)
+            shared_data = np.ndarray(data.shape, dtype=data.dtype, buffer=source.buf)
+            shared_data[...] = data
+
+            target_info = None
+            shared_result = shared_data
+            if result_shape:
+                target = shared_memory.SharedMemory(create=True, size=max(int(np.prod(result_shape)) * data.dtype.itemsize, 1))
+                blocks.append(target)
+                shared_result = np.ndarray(result_shape, dtype=data.dtype, buffer=target.buf)
+                target_info = (target.name, result_shape, data.dtype.str)
+
+            self._account(data, shared_data, shared_result)
+
+            rows = shared_result.shape[0]
+            band_rows = -(-rows // self.workers)
+            pool = _get_band_pool(self.workers)
+            futures = [
+                pool.submit(_run_shared_band, operation, (source.name, data.shape, data.dtype.str), target_info, start, stop, params)
+                for start, stop in self._bands(rows, band_rows)
+            ]
+            wait(futures)
+            for future in futures:
+                # Raises the exception of a band which failed, if any
+                future.result()
+
+            if result_shape:
+                result = self._new_buffer(result_shape, data.dtype)
+            else:
+                result = data
+
+            result[...] = shared_result
+            self._account(data, shared_data, shared_result, result)
+            del shared_data, shared_result
+            return result
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def _writable(self, data) -> np.ndarray:
+        """
+        Returns the matrix if the in place operations may write to it, otherwise a copy of it
+        (a read-only matrix is waiting to be concatenated into another image, see concat)
+        """
+        if data.flags.writeable:
+            return data
+
+        copy = self._new_buffer(data.shape, data.dtype)
+        copy[...] = data
+        self._account(data, copy)
+        return copy
+
+    def _apply_blur(self, data, blur_level, mode, threshold=False) -> np.ndarray:
+        # Every output pixel is the floored average of the blur_level x blur_level window starting at it
+        height, width = data.shape
+        result_shape = (height - blur_level + 1, width - blur_level + 1)
+
+        if self.workers > 1:
+            return self._run_parallel("blur", data, result_shape, blur_level=blur_level, mode=mode, threshold=threshold)
+
+        result = self._new_buffer(result_shape, data.dtype)
+
+        for start, stop in self._bands(result.shape[0]):
+            sums = blur_band(data, result, start, stop, blur_level, mode, threshold)
+            self._account(data, sums, result)
+
+        return result
+
+    def _apply_contour(self, data, threshold=False) -> np.ndarray:
+        # Done in place, band by band. Each band's row differences are written back compacted to width - 1,
+        # which never overtakes rows that weren't read yet, so the result is a contiguous view of the same buffer
+        height, width = data.shape
+
+        if not data.flags.c_contiguous or not data.flags.writeable:
+            contiguous = self._new_buffer(data.shape, data.dtype)
+            contiguous[...] = data
+            data = contiguous
+
+        flat = data.reshape(-1)
+        # Unsigned differences would wrap around, so they are computed in a wider signed type
+        diff_dtype = np.int16 if data.dtype == np.uint8 else data.dtype
+
+        for start, stop in self._bands(height, self.band_rows or INPLACE_BAND_ROWS):
+            band = np.abs(np.diff(data[start:stop].astype(diff_dtype, copy=False), axis=1))
+            flat[start * (width - 1):stop * (width - 1)] = band.reshape(-1)
+            self._account(data, band)
+
+        result = flat[:height * (width - 1)].reshape(height, width - 1)
+
+        if threshold:
+            return self._apply_segment(result)
+
+        return result
+
+    def _apply_rotate(self, data, k) -> np.ndarray:
+        # Every band of input rows is remapped in one go into its place in the rotated matrix
+        height, width = data.shape
+        result = self._new_buffer((width, height) if k % 2 else (height, width), data.dtype)
+
+        for start, stop in self._bands(height):
+            rotated = np.rot90(data[start:stop], k=k)
+
+            if k == 1:
+                result[:, start:stop] = rotated
+            elif k == 2:
+                result[height - stop:height - start] = rotated
+            else:
+                result[:, height - stop:height - start] = rotated
+
+            self._account(data, result)
+
+        return result
+
+    def _apply_salt_n_pepper(self, data, noise_level, seed) -> np.ndarray:
+        data = self._writable(data)
+        indices, values = salt_n_pepper_noise(data.shape, noise_level, seed)
+
+        # Apply salt (white) or pepper (black) to the randomly chosen pixels
+        np.put(data, indices, values)
+        return data
+
+    def _apply_concat(self, data, others, direction, sides, threshold=False) -> np.ndarray:
+        # The ordering matches the original rotate-concat-rotate implementation,
+        # where "top-to-bottom" ends up with image2 above image1, extended to any number of images
+        parts = [data, *others]
+        if (direction == "horizontal" and sides == "left-to-right") or (direction == "vertical" and sides == "top-to-bottom"):
+            parts.reverse()
+
+        axis = 1 if direction == "horizontal" else 0
+        shape = list(data.shape)
+        shape[axis] = sum(part.shape[axis] for part in parts)
+
+        # A single output allocation which every image is copied into at its offset
+        result = self._new_buffer(tuple(shape), np.result_type(*parts))
+        offset = 0
+        for part in parts:
+            size = part.shape[axis]
+            if axis:
+                result[:, offset:offset + size] = part
+            else:
+                result[offset:offset + size] = part
+            offset += size
+
+        self._account(result, *parts)
+
+        if threshold:
+            return self._apply_segment(result)
+
+        return result
+
+    def _apply_segment(self, data) -> np.ndarray:
+        # Done in place band by band, the data is always either a fresh result of a previous pass or owned by this image
+        data = self._writable(data)
+
+        if self.workers > 1:
+            return self._run_parallel("segment", data)
+
+        for start, stop in self._bands(data.shape[0], self.band_rows or INPLACE_BAND_ROWS):
+            mask = segment_band(data[start:stop])
+            self._account(data, mask)
+
+        return data
+
+    def blur(self, blur_level=16, mode="integral") -> None:
         """
         This method blurs the image by a blur level
 
+        The output keeps only the "valid" windows, i.e. it is (blur_level - 1) pixels smaller on each axis,
+        and each pixel is the floor of its window's average.
+
         :param blur_level: Determines the level by which to blur the image
+        :param mode: Either "integral" (default) which uses a summed-area table so the cost doesn't depend on the blur level,
+                     or "direct" which sums every window explicitly
         :return None:
         """
         try:
-            blur_level = int(abs(blur_level))
-        except ValueError as e:
+            blur_level = abs(int(blur_level))
+        except (TypeError, ValueError) as e:
             raise ValueError("Blur level must be a positive, whole number.") from e
 
-        height = len(self.data)
-        width = len(self.data[0])
-        filter_sum = blur_level ** 2
+        height, width = self.shape
+
+        if blur_level == 0:
+            raise ValueError("Blur level must be a positive, whole number.")
 
-        result = []
-        for i in range(height - blur_level + 1):
-            row_result = []
-            for j in range(width - blur_level + 1):
-                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
-                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
-                row_result.append(average)
-            result.append(row_result)
+        if blur_level > height or blur_level > width:
+            raise ValueError("Blur level may not exceed the image's height or width.")
 
-        self.data = result
+        if mode not in ["integral", "direct"]:
+            raise ValueError("Blur mode may only be 'integral' or 'direct'.")
+
+        self._plan.append(("blur", {"blur_level": blur_level, "mode": mode}))
 
     def contour(self) -> None:
         """
@@ -58,14 +748,9 @@ class Img:
 
         :return None:
         """
-        for i, row in enumerate(self.data):
-            res = []
-            for j in range(1, len(row)):
-                res.append(abs(row[j-1] - row[j]))
-
-            self.data[i] = res
+        self._plan.append(("contour", {}))
 
-    def rotate_clockwise(self, mat) -> list:
+    def rotate_clockwise(self, mat) -> np.ndarray:
         """
         This method takes in the image matrix and rotates it clockwise
 
@@ -73,18 +758,12 @@ class Img:
 
         [[10, 7, 4, 1], [11, 8, 5, 2], [12, 9, 6, 3]]
 
-        :param mat: list of lists
-        :return: list of lists - rotated matrix
+        :param mat: 2D array (or list of lists)
+        :return: 2D array - rotated matrix
         """
-        # Transpose the matrix by using zip(*mat)
-        transposed_mat = list(zip(*mat))
+        return np.rot90(np.asarray(mat), k=-1)
 
-        # Reverse each row of the transposed mat
-        rotated_mat = [list(row[::-1]) for row in transposed_mat]
-
-        return rotated_mat
-
-    def rotate_anti_clockwise(self, mat) -> list:
+    def rotate_anti_clockwise(self, mat) -> np.ndarray:
         """
         This method takes in the image matrix and rotates it anti-clockwise.
 
@@ -92,13 +771,7 @@ class Img:
 
         [[3, 6, 9, 12], [2, 5, 8, 11], [1, 4, 7, 10]]
         """
-        # First, transpose the matrix
-        transposed_mat = list(zip(*mat))
-
-        # Then reverse the order of columns in the transposed matrix
-        rotated_mat = [list(row) for row in reversed(transposed_mat)]
-
-        return rotated_mat
+        return np.rot90(np.asarray(mat), k=1)
 
     def rotate(self, direction="clockwise", deg=90) -> None:
         """
@@ -106,81 +779,57 @@ class Img:
 
         :param direction: string of either "clockwise" or "anti-clockwise" (default "clockwise")
         :param deg: integer of either 90 or 180 or 270 (default 90)
-        :return None: sets the class property data
+        :return None:
         """
         try:
-            deg = int(abs(deg))
-        except ValueError as e:
+            deg = abs(int(deg))
+        except (TypeError, ValueError) as e:
             raise ValueError("Degrees must be a positive, whole number and only 90, 180 or 270.") from e
 
         if deg not in [90, 180, 270]:
             raise ValueError("Degrees may only be 90, 180 or 270.")
 
-        mat = self.data
-
-        # Calculate the number of 90-degree rotations needed
+        # Calculate the number of 90-degree rotations needed, np.rot90 rotates anti-clockwise for positive k
         num_rotations = deg // 90
 
-        for _ in range(num_rotations):
-            if direction == "clockwise":
-                mat = self.rotate_clockwise(mat)
-            elif direction == "anti-clockwise":
-                # For anticlockwise rotation, you could directly rotate 270 degrees clockwise
-                # if the desired rotation is 270 anticlockwise, or just do it anticlockwise.
-                mat = self.rotate_anti_clockwise(mat)
+        if direction == "clockwise":
+            num_rotations = -num_rotations
+        elif direction != "anti-clockwise":
+            return
 
-        self.data = mat
+        self._plan.append(("rotate", {"k": num_rotations % 4}))
 
-
-    def salt_n_pepper(self, noise_level=0.05) -> None:
+    def salt_n_pepper(self, noise_level=0.05, seed=None) -> None:
         """
         Applies salt and pepper noise to a given grayscale image.
 
-        :param self.data: A 2D list representing the grayscale image.
         :param noise_level: A float representing the proportion of the image pixels to be affected by noise.
-        :return None: sets the class property data - A 2D list representing the image with salt and pepper noise applied.
+        :param seed: Optional int seed or numpy Generator, to make the noise reproducible (default None - random)
+        :return None:
         """
         try:
-            noise_level = float(abs(noise_level))
-        except ValueError as e:
+            noise_level = abs(float(noise_level))
+        except (TypeError, ValueError) as e:
             raise ValueError("Noise level must be a number and may be fractional.") from e
 
-        image = self.data
+        if noise_level == 0:
+            return
 
-        # Calculate the total number of pixels in the image
-        total_pixels = len(image) * len(image[0])
-
-        # Calculate the number of pixels to be affected by noise
-        affected_pixels = int(total_pixels * noise_level)
-
-        for _ in range(affected_pixels):
-            # Randomly choose a pixel in the image
-            row = random.randint(0, len(image) - 1)
-            col = random.randint(0, len(image[0]) - 1)
-
-            # Randomly decide whether to apply salt or pepper
-            if random.random() < 0.5:
-                # Apply salt (set pixel to white)
-                image[row][col] = 255
-            else:
-                # Apply pepper (set pixel to black)
-                image[row][col] = 0
-
-        self.data = image
+        self._plan.append(("salt_n_pepper", {"noise_level": noise_level, "seed": seed}))
 
     def concat(self, other_img, direction="horizontal", sides="right-to-left") -> None:
         """
-        This method concatenates two images together horizontally or vertically (side by side).
-        - Currently it is limited to concatenating only two images
+        This method concatenates images together horizontally or vertically (side by side).
+        Any number of images may be concatenated at once, in which case the result is allocated once and each image is copied into it.
 
         It checks the dimensions of both images to ensure they are compatible for concatenation and throws a RuntimeError exception if not.
-        For horizontal concatenation it checks both images' height and for vertical concatenation it rotates both images by 90deg (1 time clockwise) first using the self.rotate_clockwise() method and then check the height.
-        In addition the user is able to choose for horizontal to concat right to left or left to right of image1 and image2 respectively and for vertical to concatenate bottom to top or top to bottom of image1 and image2 respectively (this determines how the image has to be rotated prior to being concatenated)
+        For horizontal concatenation it checks both images' height and for vertical concatenation it checks both images' width.
+        In addition the user is able to choose for horizontal to concat right to left or left to right of image1 and image2 respectively and for vertical to concatenate bottom to top or top to bottom of image1 and image2 respectively
 
-        :param other_img: An instance of image
+        :param other_img: An instance of image, or a list of instances to concatenate in order after this one
         :param direction: Determines whether to concatenate horizontal or vertical (default "horizontal")
         :param sides: based on the direction the user will be able to choose which sides of the images to concatenate (default "right-to-left")
-        :return new_image: A new image instance
+        :return None:
         """
         # First I ensure that the direction matches the sides chosen
         if direction == "vertical" and sides == "right-to-left":
@@ -193,34 +842,25 @@ class Img:
         elif sides not in ["right-to-left", "left-to-right", "top-to-bottom", "bottom-to-top"]:
             raise ValueError("The sides you've chosen to concatenate aren't of the allowed options. Please refer to the 'help'.")
 
-        image1 = self.data
-        image2 = other_img.data
-
-        # Second, handle rotation if needed for vertical concatenation
-        if direction == "vertical":
-            image1 = self.rotate_clockwise(image1)
-            image2 = self.rotate_clockwise(image2)
+        other_imgs = other_img if isinstance(other_img, (list, tuple)) else [other_img]
+        height, width = self.shape
 
         # Check if the images are compatible for concatenation
-        if len(image1) != len(image2):
-            raise RuntimeError("Images are incompatible for concatenation due to difference in height.")
-
-        # Concatenate based on direction and side
-        if direction == "horizontal":
-            if sides == "right-to-left":
-                concatenated_image = [row1 + row2 for row1, row2 in zip(image1, image2)]
-            elif sides == "left-to-right":
-                concatenated_image = [row2 + row1 for row1, row2 in zip(image1, image2)]
-        elif direction == "vertical":
-            if sides == "top-to-bottom":
-                concatenated_image = [row1 + row2 for row1, row2 in zip(image1, image2)]
-            elif sides == "bottom-to-top":
-                concatenated_image = [row2 + row1 for row1, row2 in zip(image1, image2)]
-
-            # Rotate back to original orientation
-            concatenated_image = self.rotate_anti_clockwise(concatenated_image)
-
-        self.data = concatenated_image
+        for img in other_imgs:
+            if direction == "horizontal" and height != img.shape[0]:
+                raise RuntimeError("Images are incompatible for concatenation due to difference in height.")
+            if direction == "vertical" and width != img.shape[1]:
+                raise RuntimeError("Images are incompatible for concatenation due to difference in width.")
+
+        # The other images' own pending operations have to run before they can be concatenated. Their matrices are then copied
+        # straight into the single output, so until then they're read-only: an in place operation of theirs works on a copy instead
+        others = []
+        for img in other_imgs:
+            other = img.data
+            other.flags.writeable = False
+            others.append(other)
+
+        self._plan.append(("concat", {"others": others, "direction": direction, "sides": sides}))
 
     def segment(self) -> None:
         """
@@ -229,7 +869,4 @@ class Img:
 
         :return None:
         """
-        for i, row in enumerate(self.data):
-            for j, pixel in enumerate(row):
-                # Check the intensity of each pixel
-                self.data[i][j] = 255 if pixel > 100 else 0
+        self._plan.append(("segment", {}))
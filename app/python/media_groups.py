@@ -0,0 +1,179 @@
+from loguru import logger
+from caches import TTLStore
+import threading
+import heapq
+import time
+
+class MediaGroupStore(TTLStore):
+    """
+    The pending media groups, keyed by (chat id, media group id), which are evicted if they weren't completed within the ttl.
+    """
+    def _on_evict(self, key, group):
+        logger.warning(f"Evicted stale media group {key} with {len(group['items'])} photo(s)")
+
+        # The group was given up on, so its photos mustn't be delivered again
+        for ack in group["acks"]:
+            ack()
+
+class MediaGroupCollector:
+    """
+    Collects the photos of Telegram media groups (albums) so they can be handled together.
+
+    Telegram sends every photo of a media group as a separate message and doesn't say how many photos the group has,
+    so a group is considered complete once no new photo of it arrived for `window` seconds, or once it has `max_images` photos.
+    The window is counted from when the photos were received rather than from when they were handled,
+    so photos which waited in a busy message queue don't split their group.
+
+    A single scheduler thread watches the windows. When a group is due it's handed to on_due(chat id, media group id),
+    which by default flushes it right away. The message workers set on_due to queue a flush message (see flush_message) behind
+    the group's photos instead, so the concatenation runs on a message worker of the chat, after every photo received in time.
+    A flushed group is handed, ordered by message id, to the callback given along with its photos.
+    The acks held for the group's messages (see hold) are called once the callback returned.
+    Groups older than `max_age` seconds which were never completed are evicted.
+    """
+    FLUSH = "media_group_flush"
+
+    def __init__(self, window=1.5, max_age=60, max_images=10, max_groups=1000):
+        self.window = window
+        self.max_images = max_images
+        self.on_due = None
+        self._groups = MediaGroupStore(max_age, max_groups)
+        # Heap of (deadline, key), a group may have stale entries from before its deadline was moved
+        self._due = []
+        self._condition = threading.Condition()
+        self._scheduler = None
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self._groups)
+
+    @property
+    def evicted(self):
+        return self._groups.evictions
+
+    @classmethod
+    def flush_message(cls, chat_id, media_group_id) -> dict:
+        """
+        :return: a message which flushes the media group when it's handled
+        """
+        return {"chat": {"id": chat_id}, "media_group_id": media_group_id, cls.FLUSH: True}
+
+    @classmethod
+    def is_flush_message(cls, msg) -> bool:
+        return isinstance(msg, dict) and bool(msg.get(cls.FLUSH))
+
+    def add(self, chat_id, media_group_id, message_id, image, on_complete, received=None, **options) -> bool:
+        """
+        Adds a photo to its media group and moves the group's deadline to `window` seconds after the photo was received.
+
+        :param chat_id: The chat the photo was sent in
+        :param media_group_id: The media group the photo belongs to
+        :param message_id: The id of the photo's message, which determines the order of the photos in the group
+        :param image: The photo itself
+        :param on_complete: callable(images, **options) - called with the group's photos once it's complete
+        :param received: The epoch time the photo's message was received at (default - now)
+        :param options: Options of the whole group, e.g. the concat direction and sides from the caption,
+                        which comes with only one of the photos. Empty values don't override earlier ones.
+        :return: True if this is the first photo of the group
+        """
+        key = (chat_id, media_group_id)
+
+        with self._condition:
+            group = self._groups.get(key)
+            is_new = group is None
+
+            if is_new:
+                group = {"items": [], "options": {}, "deadline": 0.0, "acks": []}
+                # The group's ttl runs from its first photo, it isn't extended by the next ones
+                self._groups.set(key, group)
+
+            group["items"].append((message_id, image))
+            group["options"].update({name: value for name, value in options.items() if value})
+            group["on_complete"] = on_complete
+            group["deadline"] = max(group["deadline"], (received or time.time()) + self.window)
+
+            is_complete = len(group["items"]) >= self.max_images
+
+            if not is_complete:
+                heapq.heappush(self._due, (group["deadline"], key))
+                self._start_scheduler()
+                self._condition.notify()
+
+        if is_complete:
+            self.flush(chat_id, media_group_id, force=True)
+
+        return is_new
+
+    def hold(self, chat_id, media_group_id, ack) -> bool:
+        """
+        Holds the ack of a message of the media group until the group was handled,
+        so if the service stops before that the group's messages are delivered again.
+
+        :param ack: callable() - acks the message
+        :return: True if the ack is held, False if the group isn't pending (any more)
+        """
+        with self._condition:
+            group = self._groups.get((chat_id, media_group_id))
+
+            if group is None:
+                return False
+
+            group["acks"].append(ack)
+
+        return True
+
+    def flush(self, chat_id, media_group_id, force=False) -> bool:
+        """
+        Hands the media group's photos to its callback and forgets the group.
+
+        :param force: Flush the group even if a photo received since it was due moved its deadline
+        :return: True if the group was flushed, False if there is no such group or it isn't due yet
+        """
+        with self._condition:
+            group = self._groups.get((chat_id, media_group_id))
+
+            if group is None or (not force and group["deadline"] > time.time()):
+                return False
+
+            self._groups.pop((chat_id, media_group_id))
+
+        self.flushed += 1
+        images = [image for _, image in sorted(group["items"], key=lambda item: item[0])]
+
+        try:
+            group["on_complete"](images, **group["options"])
+        except Exception as e:
+            # May run on the scheduler's thread, where nobody else would see the error
+            logger.exception(f"Was unable to handle media group {media_group_id} of chat {chat_id}.\n{e}")
+        finally:
+            # A group which failed isn't retried either, the callback already reported the error to the user
+            for ack in group["acks"]:
+                ack()
+
+        return True
+
+    def _start_scheduler(self) -> None:
+        """
+        Starts (under the lock) the scheduler thread on first use
+        """
+        if self._scheduler is None:
+            self._scheduler = threading.Thread(target=self._schedule, name="MediaGroupScheduler", daemon=True)
+            self._scheduler.start()
+
+    def _schedule(self) -> None:
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.time():
+                    self._condition.wait(self._due[0][0] - time.time() if self._due else None)
+
+                deadline, key = heapq.heappop(self._due)
+                group = self._groups.get(key)
+
+                # Flushed, evicted, or a later photo moved its deadline since
+                if group is None or group["deadline"] != deadline:
+                    continue
+
+            try:
+                (self.on_due or self.flush)(*key)
+            except Exception as e:
+                logger.exception(f"Was unable to flush media group {key[1]} of chat {key[0]}.\n{e}")
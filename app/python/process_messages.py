@@ -1,5 +1,340 @@
-from threading import Thread
+from threading import Thread, Lock
+from queue import Queue
 from loguru import logger
+from queue_backends import MemoryQueueBackend
+import functools
+import heapq
+import time
+import os
+
+# The relative cost of each image operation per megapixel, an operation missing from the caption costs as a blur
+OPERATION_COSTS = {"blur": 3.0, "concat": 2.0, "contour": 1.0, "segment": 1.0, "salt and pepper": 1.0, "rotate": 1.0}
+# A prediction is mostly waiting on S3 and SQS, so it costs the same whatever the photo's size
+PREDICTION_COST = 0.2
+# Messages which cost less than this go to the cheap lane, which has workers of its own
+CHEAP_COST_THRESHOLD = float(os.getenv('CHEAP_COST_THRESHOLD', '0.5'))
+
+def is_prediction(msg) -> bool:
+    """
+    Check if it's a photo sent for object detection
+    """
+    return (isinstance(msg, dict) and "photo" in msg and "reply_to_message" not in msg
+            and msg.get("caption", "").strip().lower() in ["predict", "prediction_result"])
+
+def estimate_cost(msg) -> float:
+    """
+    Estimates how expensive a message is to handle before it's queued, from its photo's dimensions and the requested operation.
+    Text messages cost nothing, a photo costs its megapixels times the operation's cost.
+    """
+    if not isinstance(msg, dict) or "photo" not in msg or "reply_to_message" in msg:
+        return 0.0
+
+    if is_prediction(msg):
+        return PREDICTION_COST
+
+    photo_size = msg["photo"][-1] if msg["photo"] else {}
+    megapixels = photo_size.get("width", 0) * photo_size.get("height", 0) / 1e6
+    caption = msg.get("caption", "").strip().lower()
+
+    weight = max([cost for operation, cost in OPERATION_COSTS.items() if operation in caption] or [OPERATION_COSTS["blur"]])
+
+    return megapixels * weight
+
+class MessageShard(Queue):
+    """
+    A message queue which serves the chats fairly and records how long its messages waited in it.
+
+    It's a weighted fair queue: every message gets a virtual finish time, which is its chat's previous finish time
+    (or the queue's current virtual time if the chat was idle) plus the message's cost, and the message with the earliest
+    finish time is served first. A chat sending many expensive messages thus doesn't hold back the others,
+    while the messages of each chat are still served in the order they arrived.
+    """
+    def __init__(self, backend=None, maxsize=0):
+        super().__init__(maxsize)
+        # The backend the queue's messages are journaled in, the workers lease and ack the messages through it
+        self.backend = backend or MemoryQueueBackend()
+        self.waited = 0.0
+        self.max_waited = 0.0
+        self.handled = 0
+
+    # _init, _qsize, _put and _get are called by Queue, the last three under its own lock
+    def _init(self, maxsize):
+        self.queue = []
+        self.virtual_time = 0.0
+        self.finish_times = {}
+        self.sequence = 0
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        """
+        :param item: tuple of (chat id, cost, job id, message)
+        """
+        chat_id, cost, job_id, msg = item
+        # Even free messages advance the chat's finish time a little, so a chat can't flood the queue for free
+        finish = max(self.virtual_time, self.finish_times.get(chat_id, 0.0)) + max(cost, 0.01)
+        self.finish_times[chat_id] = finish
+        self.sequence += 1
+        heapq.heappush(self.queue, (finish, self.sequence, time.monotonic(), job_id, msg))
+
+    def _get(self):
+        """
+        :return: tuple of (job id, message)
+        """
+        finish, _, enqueued, job_id, msg = heapq.heappop(self.queue)
+        self.virtual_time = finish
+
+        # Chats which are behind the virtual time would start from it anyway, so they needn't be remembered
+        if len(self.finish_times) > 1000:
+            self.finish_times = {chat_id: finish for chat_id, finish in self.finish_times.items() if finish > self.virtual_time}
+
+        waited = time.monotonic() - enqueued
+        self.waited += waited
+        self.max_waited = max(self.max_waited, waited)
+        self.handled += 1
+
+        return job_id, msg
+
+class ShardedMessageQueue:
+    """
+    A set of message queues, one per message worker, where every message of a chat goes to the same queue.
+    The messages of a chat are thus handled in order, one at a time, while different chats are handled concurrently.
+
+    The queues are split into lanes with workers of their own, so cheap messages (text replies) never wait behind
+    expensive image jobs, and predictions (which mostly wait on the network) don't hold up either. Within a lane the messages
+    of a chat are still handled in order, and every photo of a media group goes to the same lane whatever its caption.
+
+    The total number of queued messages is bounded. Once it reaches the high watermark the queue starts shedding load:
+    low priority messages (plain text to echo) are dropped until it's back down to the low watermark,
+    and once it reaches max_size every message is rejected so the sender retries it later.
+    """
+    QUEUED = "queued"
+    DROPPED = "dropped"
+    REJECTED = "rejected"
+
+    def __init__(self, shards=1, max_size=0, high_watermark=None, low_watermark=None, cheap_shards=1, backend=None, ingress_only=False,
+                 io_shards=1):
+        """
+        :param shards: The number of queues for expensive messages
+        :param max_size: The maximum total number of queued messages (0 - unbounded)
+        :param high_watermark: The number of queued messages at which low priority ones start being dropped (default - 80% of max_size)
+        :param low_watermark: The number of queued messages at which low priority ones are accepted again (default - half of high_watermark)
+        :param cheap_shards: The number of queues for cheap messages
+        :param backend: The backend the accepted messages are journaled in (default - in memory only)
+        :param ingress_only: Only append the accepted messages to the backend, for worker processes sharing it to claim.
+                             The queue's depth is then the backend's.
+        :param io_shards: The number of queues for predictions
+        """
+        self.backend = backend or MemoryQueueBackend()
+        if ingress_only and type(self.backend) is MemoryQueueBackend:
+            raise ValueError("A queue which only appends the messages needs a backend shared with the workers e.g. sqlite.")
+
+        self.lanes = {
+            "cheap": [MessageShard(self.backend) for _ in range(max(1, cheap_shards))],
+            "io": [MessageShard(self.backend) for _ in range(max(1, io_shards))],
+            "expensive": [MessageShard(self.backend) for _ in range(max(1, shards))],
+        }
+        self.shards = self.lanes["cheap"] + self.lanes["io"] + self.lanes["expensive"]
+        self.max_size = max_size
+        self.high_watermark = high_watermark or int(max_size * 0.8)
+        self.low_watermark = low_watermark if low_watermark is not None else self.high_watermark // 2
+        self.shedding = False
+        self.queued = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.ingress_only = ingress_only
+        self.feeding = False
+        self._lock = Lock()
+
+    def chat_of(self, msg):
+        return (msg.get("chat") or {}).get("id", 0) if isinstance(msg, dict) else 0
+
+    def lane_of(self, msg, cost) -> str:
+        # The photos of a media group are costed by their own captions, which only one of them has
+        if isinstance(msg, dict) and "media_group_id" in msg:
+            return "expensive"
+        if is_prediction(msg):
+            return "io"
+
+        return "cheap" if cost < CHEAP_COST_THRESHOLD else "expensive"
+
+    def shard_of(self, msg, lane="expensive") -> MessageShard:
+        """
+        :return: the queue of the lane for the message's chat
+        """
+        shards = self.lanes[lane]
+
+        return shards[hash(self.chat_of(msg)) % len(shards)]
+
+    def is_low_priority(self, msg) -> bool:
+        """
+        Check if it's a plain message which is only echoed back, and is the first to be dropped under load
+        """
+        return isinstance(msg, dict) and "photo" not in msg and "reply_to_message" not in msg
+
+    def put(self, msg) -> str:
+        """
+        Queues the message unless the queue is shedding load.
+
+        :return: QUEUED, DROPPED if it was a low priority message dropped under load,
+                 or REJECTED if the queue is full and the message should be retried later
+        """
+        with self._lock:
+            if self.max_size:
+                depth = self.qsize()
+
+                if depth >= self.high_watermark and not self.shedding:
+                    self.shedding = True
+                    logger.warning(f"Message queue reached {depth} messages, shedding load")
+                elif depth <= self.low_watermark and self.shedding:
+                    self.shedding = False
+                    logger.info(f"Message queue is down to {depth} messages, no longer shedding load")
+
+                if depth >= self.max_size:
+                    self.rejected += 1
+                    return self.REJECTED
+
+                if self.shedding and self.is_low_priority(msg):
+                    self.dropped += 1
+                    return self.DROPPED
+
+            self.queued += 1
+            # The time it was received at, e.g. a media group's window is counted from its photos' arrival
+            if isinstance(msg, dict):
+                msg = dict(msg, received_at=time.time())
+            job_id = self.backend.append(msg, self.chat_of(msg))
+
+            if not self.ingress_only:
+                self._route(job_id, msg)
+
+        return self.QUEUED
+
+    def put_internal(self, msg) -> None:
+        """
+        Queues a message the service made itself, e.g. the flush of a media group. It's never dropped or rejected,
+        and it goes through the backend like the messages of its chat, so it's handled after the ones received before it.
+        """
+        with self._lock:
+            job_id = self.backend.append(msg, self.chat_of(msg))
+
+            # A feeding worker process claims it from the shared backend along with the rest
+            if not self.ingress_only and not self.feeding:
+                self._route(job_id, msg)
+
+    def _route(self, job_id, msg) -> None:
+        cost = estimate_cost(msg)
+        self.shard_of(msg, self.lane_of(msg, cost)).put((self.chat_of(msg), cost, job_id, msg))
+
+    def replay(self) -> int:
+        """
+        Queues again the messages the backend kept from a previous run which weren't handled.
+        :return: the number of replayed messages
+        """
+        jobs = self.backend.replay()
+        for job_id, msg in jobs:
+            self._route(job_id, msg)
+
+        return len(jobs)
+
+    def redeliver_expired(self) -> int:
+        """
+        Queues again the messages which weren't acked within the backend's visibility timeout.
+        :return: the number of redelivered messages
+        """
+        jobs = self.backend.expired()
+        for job_id, msg in jobs:
+            logger.warning(f"Message {job_id} wasn't handled within the visibility timeout, delivering it again")
+            # When the messages are claimed from a shared backend, the released message is claimed again like any other
+            if not self.feeding:
+                self._route(job_id, msg)
+
+        return len(jobs)
+
+    def watch_visibility(self, interval=30) -> Thread:
+        """
+        Starts a thread which redelivers the expired messages every interval seconds.
+        """
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.redeliver_expired()
+                except Exception as e:
+                    logger.exception(f"Was unable to redeliver the expired messages.\n{e}")
+
+        thread = Thread(target=watch, name="VisibilityWatcher", daemon=True)
+        thread.start()
+
+        return thread
+
+    def start_feeder(self, capacity=None, poll_interval=0.2, partition=0, partitions=1) -> Thread:
+        """
+        Starts a thread which claims the messages appended to the shared backend by the webhook processes,
+        keeping up to capacity of them in the local queues so the rest stay available to the other worker processes.
+        Every worker process claims the messages of its own partition of the chats, so a chat's messages are handled in order.
+
+        :param capacity: The number of messages to hold locally (default - two per worker)
+        :param poll_interval: The number of seconds to wait before polling again when there was nothing to claim
+        :param partition: The index of this worker process
+        :param partitions: The number of worker processes sharing the backend
+        """
+        capacity = capacity or 2 * len(self.shards)
+        self.feeding = True
+
+        def feed():
+            while True:
+                try:
+                    room = capacity - sum(shard.qsize() for shard in self.shards)
+                    jobs = self.backend.claim(room, partition, partitions) if room > 0 else []
+
+                    for job_id, msg in jobs:
+                        self._route(job_id, msg)
+
+                    if not jobs:
+                        time.sleep(poll_interval)
+                except Exception as e:
+                    logger.exception(f"Was unable to claim messages from the queue backend.\n{e}")
+                    time.sleep(poll_interval)
+
+        thread = Thread(target=feed, name="QueueFeeder", daemon=True)
+        thread.start()
+
+        return thread
+
+    def qsize(self) -> int:
+        if self.ingress_only:
+            return self.backend.depth()
+
+        return sum(shard.qsize() for shard in self.shards)
+
+    def depths(self) -> list:
+        """
+        :return: list of the number of messages waiting in each of the queues
+        """
+        return [shard.qsize() for shard in self.shards]
+
+    def stats(self) -> dict:
+        """
+        :return: dict of the queue's depth, the number of queued, dropped and rejected messages and the time messages waited in it.
+                 A queue which only appends the messages has no local queues, its depth is the backend's.
+        """
+        depths = self.depths()
+        handled = sum(shard.handled for shard in self.shards)
+
+        return {
+            "messages": self.qsize(),
+            "shards": depths,
+            "lanes": {lane: [shard.qsize() for shard in shards] for lane, shards in self.lanes.items()},
+            "max_size": self.max_size,
+            "shedding": self.shedding,
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "avg_wait_seconds": sum(shard.waited for shard in self.shards) / handled if handled else 0.0,
+            "max_wait_seconds": max(shard.max_waited for shard in self.shards),
+            **self.backend.stats(),
+        }
 
 class ProcessMessages(Thread):
     def __init__(self, app, bot_factory, message_queue):
@@ -13,10 +348,21 @@ class ProcessMessages(Thread):
             while True:
                 try:
                     # Wait for a message from the queue
-                    msg = self.message_queue.get()
-                    if msg:
-                        bot = self.bot_factory.get_bot(msg)
-                        bot.handle_message(msg)
-                        logger.debug(f"Message processed: {msg}")
+                    job_id, msg = self.message_queue.get()
+                    self.message_queue.backend.lease(job_id)
+                    ack = functools.partial(self.message_queue.backend.ack, job_id)
+                    try:
+                        if msg:
+                            bot = self.bot_factory.get_bot(msg)
+                            bot.handle_message(msg)
+                            logger.debug(f"Message processed: {msg}")
+
+                            # e.g. the photos of a media group, which are acked once the whole group was handled
+                            if bot.defer_ack(msg, ack):
+                                ack = None
+                    finally:
+                        # A message which failed isn't retried, the bot already reported the error to the user
+                        if ack:
+                            ack()
                 except Exception as e:
-                    logger.exception(f"Error in ProcessMessages thread: {e}")
\ No newline at end of file
+                    logger.exception(f"Error in ProcessMessages thread: {e}")
@@ -1,31 +1,153 @@
-from threading import Thread
-import boto3
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from aws_clients import aws_clients
+import math
 import os
 import json
 
+# SQS returns at most 10 messages per receive, and waits at most 20 seconds for them (long polling)
+RECEIVE_BATCH_SIZE = 10
+RECEIVE_WAIT_SECONDS = 20
+
 class ProcessResults(Thread):
-    def __init__(self, app, bot_factory):
+    """
+    A poller of the results queue: it receives the results in batches, handles them on a pool of handler threads (shared by all
+    the pollers of a ResultsConsumer) and deletes the handled ones in batches. It waits for a batch to be handled before it receives
+    the next one, so it never holds more than a batch of results whose visibility timeout runs out while they wait for a handler.
+    A result which failed isn't deleted, so SQS delivers it again after its visibility timeout.
+    """
+    def __init__(self, app, bot_factory, sqs_client=None, queue_name=None, executor=None, stop_event=None):
         Thread.__init__(self)
         self.app = app
         self.bot_factory = bot_factory
-        self.sqs_client = boto3.client('sqs', region_name=os.environ['AWS_DEFAULT_REGION'])
-        self.queue_name = os.environ['SQS_QUEUE_RESULTS']
+        self.sqs_client = sqs_client or aws_clients.get('sqs', os.environ['AWS_DEFAULT_REGION'])
+        self.queue_name = queue_name or os.environ['SQS_QUEUE_RESULTS']
+        self.executor = executor or ThreadPoolExecutor(max_workers=RECEIVE_BATCH_SIZE)
+        self.stop_event = stop_event or Event()
+
+    def handle_result(self, message):
+        """
+        Handles a received result with the bot.
+        :return: the result's receipt handle if it was handled, otherwise None
+        """
+        try:
+            with self.app.app_context():
+                msg = json.loads(message['Body']).get("message")
+                bot = self.bot_factory.get_bot(msg)
+
+                # Handle the message with the bot
+                bot.handle_message(msg)
+
+            return message['ReceiptHandle']
+        except Exception as e:
+            logger.exception(f"Error while handling result {message.get('MessageId')}: {e}")
+            return None
+
+    def delete_results(self, receipt_handles):
+        """
+        Deletes the handled results from the queue, as their jobs are considered as DONE
+        """
+        for start in range(0, len(receipt_handles), RECEIVE_BATCH_SIZE):
+            entries = [{"Id": str(index), "ReceiptHandle": receipt_handle}
+                       for index, receipt_handle in enumerate(receipt_handles[start:start + RECEIVE_BATCH_SIZE])]
+            response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_name, Entries=entries)
+
+            for failed in response.get('Failed', []):
+                logger.error(f"Was unable to delete a handled result from the queue: {failed}")
 
     def run(self):
-        with self.app.app_context():
-            while True:
-                response = self.sqs_client.receive_message(QueueUrl=self.queue_name, MaxNumberOfMessages=1, WaitTimeSeconds=5)
+        while not self.stop_event.is_set():
+            try:
+                response = self.sqs_client.receive_message(QueueUrl=self.queue_name, MaxNumberOfMessages=RECEIVE_BATCH_SIZE,
+                                                           WaitTimeSeconds=RECEIVE_WAIT_SECONDS)
+
+                futures = [self.executor.submit(self.handle_result, message) for message in response.get('Messages', [])]
+                receipt_handles = [receipt_handle for receipt_handle in (future.result() for future in futures) if receipt_handle]
 
-                if 'Messages' in response:
-                    message = json.loads(response['Messages'][0]['Body'])
-                    receipt_handle = response['Messages'][0]['ReceiptHandle']
+                if receipt_handles:
+                    self.delete_results(receipt_handles)
+            except Exception as e:
+                logger.exception(f"Error in ProcessResults thread: {e}")
+                self.stop_event.wait(1)
 
-                    # Process the message here
-                    msg = message.get("message")
-                    bot = self.bot_factory.get_bot(msg)
+class ResultsConsumer(Thread):
+    """
+    Consumes the results queue with between min_pollers and max_pollers ProcessResults pollers, all sharing one bounded pool
+    of handler threads. Every scale_interval seconds it checks the queue's backlog and runs a poller per
+    messages_per_poller messages waiting in it.
+    """
+    def __init__(self, app, bot_factory, min_pollers=1, max_pollers=4, handler_threads=8, messages_per_poller=50, scale_interval=30):
+        Thread.__init__(self)
+        self.app = app
+        self.bot_factory = bot_factory
+        self.min_pollers = max(1, min_pollers)
+        self.max_pollers = max(self.min_pollers, max_pollers)
+        self.messages_per_poller = messages_per_poller
+        self.scale_interval = scale_interval
+        self.sqs_client = aws_clients.get('sqs', os.environ['AWS_DEFAULT_REGION'])
+        self.queue_name = os.environ['SQS_QUEUE_RESULTS']
+        self.executor = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix="ResultHandler")
+        self.pollers = []
+        self.backlog = 0
+        self._lock = Lock()
+        self.stop_event = Event()
+
+    def scale(self, pollers) -> None:
+        """
+        Starts or stops pollers so there are this many running (within min_pollers and max_pollers)
+        """
+        pollers = min(max(pollers, self.min_pollers), self.max_pollers)
+        # Once the consumer is stopped, so is every poller, including one a scaling in progress would have started
+        if self.stop_event.is_set():
+            pollers = 0
+
+        with self._lock:
+            # A stopped poller finishes its current batch before it exits
+            self.pollers = [poller for poller in self.pollers if poller.is_alive() and not poller.stop_event.is_set()]
+
+            if pollers > len(self.pollers):
+                logger.info(f"Scaling the results pollers up from {len(self.pollers)} to {pollers} (backlog {self.backlog})")
+            elif pollers < len(self.pollers):
+                logger.info(f"Scaling the results pollers down from {len(self.pollers)} to {pollers} (backlog {self.backlog})")
+
+            while len(self.pollers) < pollers:
+                poller = ProcessResults(self.app, self.bot_factory, self.sqs_client, self.queue_name, self.executor)
+                poller.daemon = True
+                poller.start()
+                self.pollers.append(poller)
+
+            while len(self.pollers) > pollers:
+                self.pollers.pop().stop_event.set()
+
+    def observe_backlog(self) -> int:
+        """
+        :return: the approximate number of results waiting in the queue
+        """
+        response = self.sqs_client.get_queue_attributes(QueueUrl=self.queue_name, AttributeNames=['ApproximateNumberOfMessages'])
+
+        return int(response.get('Attributes', {}).get('ApproximateNumberOfMessages', 0))
+
+    def stats(self) -> dict:
+        return {"pollers": len(self.pollers), "backlog": self.backlog}
+
+    def stop(self) -> None:
+        """
+        Stops scaling and stops all the pollers, each finishing its current batch before it exits
+        """
+        self.stop_event.set()
+        self.scale(0)
+
+    def run(self):
+        self.scale(self.min_pollers)
 
-                    # Handle the message with the bot
-                    bot.handle_message(msg)
+        while not self.stop_event.is_set():
+            try:
+                self.backlog = self.observe_backlog()
+                self.scale(math.ceil(self.backlog / self.messages_per_poller))
+            except Exception as e:
+                logger.exception(f"Was unable to scale the results pollers: {e}")
+                # Whatever happened, the pollers which died are replaced
+                self.scale(len(self.pollers))
 
-                    # Delete the message from the queue as the job is considered as DONE
-                    self.sqs_client.delete_message(QueueUrl=self.queue_name, ReceiptHandle=receipt_handle)
+            self.stop_event.wait(self.scale_interval)
@@ -0,0 +1,498 @@
+from loguru import logger
+from caches import TTLStore
+import itertools
+import threading
+import sqlite3
+import json
+import time
+import uuid
+import os
+
+class MemoryQueueBackend:
+    """
+    The default message queue backend, which keeps nothing beyond the in-memory queues themselves,
+    so messages which weren't handled yet are lost when the process stops.
+    """
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def append(self, msg, chat_id=0) -> int:
+        """
+        Records a message accepted into the queue.
+        :param chat_id: The chat the message belongs to, whose messages are all claimed by the same process
+        :return: the message's job id
+        """
+        return next(self._ids)
+
+    def lease(self, job_id) -> None:
+        """
+        Records that a worker started handling the message.
+        """
+        pass
+
+    def ack(self, job_id) -> None:
+        """
+        Records that the message was handled, so it's never delivered again.
+        """
+        pass
+
+    def replay(self) -> list:
+        """
+        :return: list of (job id, message) of the messages left unhandled by a previous run
+        """
+        return []
+
+    def claim(self, limit, partition=0, partitions=1) -> list:
+        """
+        Claims messages appended by other processes sharing the backend, in the order they were appended.
+        :param partition: The index of the claiming process, which only claims the messages of its partition of the chats
+        :param partitions: The number of processes claiming messages
+        :return: list of (job id, message)
+        """
+        return []
+
+    def depth(self) -> int:
+        """
+        :return: the number of messages appended and not acked yet, by all the processes sharing the backend
+        """
+        return 0
+
+    def expired(self) -> list:
+        """
+        :return: list of (job id, message) of the messages whose worker didn't ack them within the visibility timeout
+        """
+        return []
+
+    def stats(self) -> dict:
+        return {"backend": "memory"}
+
+    def close(self) -> None:
+        pass
+
+class SQLiteQueueBackend(MemoryQueueBackend):
+    """
+    A durable message queue backend: every accepted message is journaled to a SQLite database (in WAL mode)
+    until it's acked, so the messages left unhandled when the process stopped are replayed when it starts again.
+    The database may also be shared by several processes on the same host, e.g. webhook processes which only append the messages
+    and worker processes which claim them.
+
+    To keep the webhook fast, appending only adds the message to a batch in memory, and a writer thread commits the batches
+    every flush_interval seconds (or once they reach batch_size) in a single transaction. A crash thus loses at most
+    the last flush_interval seconds of messages instead of all of them.
+
+    A message leased by a worker and not acked within visibility_timeout seconds (e.g. its worker hung) is delivered again,
+    up to max_attempts times.
+    """
+    def __init__(self, path, batch_size=100, flush_interval=0.05, visibility_timeout=300, max_attempts=5, depth_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.depth_interval = depth_interval
+        self._depth = (0.0, 0)
+        self.commits = 0
+        self.redelivered = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode a commit is durable once the WAL is synced at a checkpoint, which is enough for a journal
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Other processes sharing the database may hold its write lock for a moment
+        self._db.execute("PRAGMA busy_timeout=5000")
+        # The messages are kept in the order they were appended (their rowid), the ids are handed out in memory
+        # so appending never waits for the database, and they're unique across the processes sharing it
+        # A message is claimed by a worker process (its pid) when it's taken into the process' local queue,
+        # and leased once a worker actually starts handling it
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, body TEXT NOT NULL, "
+                         "leased REAL, attempts INTEGER NOT NULL DEFAULT 0, claimed_by INTEGER, chat INTEGER NOT NULL DEFAULT 0)")
+        self._add_columns({"claimed_by": "INTEGER", "chat": "INTEGER NOT NULL DEFAULT 0"})
+        self._db_lock = threading.Lock()
+
+        self._pending = []
+        self._pending_lock = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_batches, name="SQLiteQueueWriter", daemon=True)
+        self._writer.start()
+
+    def _add_columns(self, columns) -> None:
+        """
+        Adds the columns missing from a journal created by an earlier version
+        """
+        existing = {row[1] for row in self._db.execute("PRAGMA table_info(messages)")}
+
+        for column, definition in columns.items():
+            if column not in existing:
+                self._db.execute(f"ALTER TABLE messages ADD COLUMN {column} {definition}")
+
+    def append(self, msg, chat_id=0) -> str:
+        job_id = uuid.uuid4().hex
+        self._add_pending(("insert", job_id, (json.dumps(msg), chat_id)))
+
+        return job_id
+
+    def lease(self, job_id) -> None:
+        self._add_pending(("lease", job_id, time.time()))
+
+    def ack(self, job_id) -> None:
+        self._add_pending(("ack", job_id, None))
+
+    def _add_pending(self, operation) -> None:
+        with self._pending_lock:
+            self._pending.append(operation)
+            if len(self._pending) >= self.batch_size:
+                self._pending_lock.notify()
+
+    def _write_batches(self) -> None:
+        while True:
+            with self._pending_lock:
+                # Waits for the batch to fill up, or for the flush interval to pass
+                if len(self._pending) < self.batch_size and not self._closed:
+                    self._pending_lock.wait(self.flush_interval)
+                if self._closed and not self._pending:
+                    return
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Was unable to write to the message queue journal {self.path}.\n{e}")
+                time.sleep(self.flush_interval)
+
+    def flush(self) -> None:
+        """
+        Commits all the pending operations in a single transaction.
+        """
+        # Batches are taken and committed under the same lock, so they're committed in the order they were taken
+        with self._db_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+
+            if not batch:
+                return
+
+            # A message acked in the same batch it was appended in never has to be written at all
+            acked = {job_id for operation, job_id, _ in batch if operation == "ack"}
+            inserted = {job_id for operation, job_id, _ in batch if operation == "insert"}
+            skipped = acked & inserted
+
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                for operation, job_id, value in batch:
+                    if job_id in skipped:
+                        continue
+                    if operation == "insert":
+                        self._db.execute("INSERT INTO messages (id, body, chat) VALUES (?, ?, ?)", (job_id, *value))
+                    elif operation == "lease":
+                        self._db.execute("UPDATE messages SET leased = ?, attempts = attempts + 1 WHERE id = ?", (value, job_id))
+                    else:
+                        self._db.execute("DELETE FROM messages WHERE id = ?", (job_id,))
+                self._db.execute("COMMIT")
+                self.commits += 1
+            except Exception:
+                self._db.execute("ROLLBACK")
+                # Put the batch back so it's retried with the next one
+                with self._pending_lock:
+                    self._pending = batch + self._pending
+                raise
+
+    def replay(self) -> list:
+        """
+        Returns the messages left unhandled by a previous run, including the ones which were being handled when it stopped.
+        """
+        self.release_leases()
+
+        with self._db_lock:
+            rows = self._db.execute("SELECT id, body FROM messages ORDER BY rowid").fetchall()
+
+        if rows:
+            logger.info(f"Replaying {len(rows)} unhandled message(s) from {self.path}")
+
+        return [(job_id, json.loads(body)) for job_id, body in rows]
+
+    def release_leases(self) -> None:
+        """
+        Releases the claims and leases of all the messages, which must only be done while no process is handling any of them.
+        """
+        self.flush()
+
+        with self._db_lock:
+            self._db.execute("UPDATE messages SET leased = NULL, claimed_by = NULL")
+
+    def release_claims(self, pid) -> None:
+        """
+        Releases the messages claimed by a worker process which exited, whether it started handling them or not.
+        """
+        self.flush()
+
+        with self._db_lock:
+            self._db.execute("UPDATE messages SET leased = NULL, claimed_by = NULL WHERE claimed_by = ?", (pid,))
+
+    def claim(self, limit, partition=0, partitions=1) -> list:
+        """
+        Claims up to limit of the messages of the partition's chats which aren't claimed yet, the oldest first.
+        Every chat belongs to one partition, so all of its messages (e.g. the photos of a media group) are handled
+        by the same process, in order.
+        The claim is taken in a write transaction, so no two processes ever claim the same message. It doesn't time out:
+        the visibility timeout only starts once a worker leases the message, however long it waited in the local queue,
+        and the claims of a process which exited are released with release_claims.
+        """
+        self.flush()
+
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute("SELECT id, body FROM messages WHERE claimed_by IS NULL AND leased IS NULL AND abs(chat) % ? = ? "
+                                        "ORDER BY rowid LIMIT ?", (partitions, partition, limit)).fetchall()
+                pid = os.getpid()
+                self._db.executemany("UPDATE messages SET claimed_by = ? WHERE id = ?", [(pid, job_id) for job_id, _ in rows])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+        return [(job_id, json.loads(body)) for job_id, body in rows]
+
+    def depth(self) -> int:
+        """
+        Returns the number of messages not acked yet, counted at most every depth_interval seconds
+        so it's cheap enough to check on every append.
+        """
+        counted, depth = self._depth
+        now = time.monotonic()
+
+        if now - counted >= self.depth_interval:
+            with self._db_lock:
+                depth = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            self._depth = (now, depth)
+
+        with self._pending_lock:
+            return depth + sum(1 for operation, _, _ in self._pending if operation == "insert")
+
+    def expired(self) -> list:
+        """
+        Returns the leased messages whose visibility timeout passed, releasing their lease (and claim).
+        The messages which already had max_attempts attempts are dropped instead.
+        """
+        self.flush()
+        deadline = time.time() - self.visibility_timeout
+
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            rows = self._db.execute("SELECT id, body, attempts FROM messages WHERE leased IS NOT NULL AND leased < ?", (deadline,)).fetchall()
+
+            for job_id, _, attempts in rows:
+                if attempts >= self.max_attempts:
+                    self._db.execute("DELETE FROM messages WHERE id = ?", (job_id,))
+                else:
+                    self._db.execute("UPDATE messages SET leased = NULL, claimed_by = NULL WHERE id = ?", (job_id,))
+            self._db.execute("COMMIT")
+
+        dropped = [job_id for job_id, _, attempts in rows if attempts >= self.max_attempts]
+        if dropped:
+            logger.error(f"Dropped message(s) {dropped} after {self.max_attempts} attempts")
+
+        redelivered = [(job_id, json.loads(body)) for job_id, body, attempts in rows if attempts < self.max_attempts]
+        self.redelivered += len(redelivered)
+
+        return redelivered
+
+    def stats(self) -> dict:
+        """
+        :return: dict of the number of journaled messages: in total, not claimed by any process yet (pending),
+                 claimed by a process and leased by a worker, and of the operations not committed yet
+        """
+        with self._db_lock:
+            journaled, pending, claimed, leased = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(claimed_by IS NULL AND leased IS NULL), 0), COUNT(claimed_by), COUNT(leased) FROM messages").fetchone()
+
+        with self._pending_lock:
+            pending_writes = len(self._pending)
+
+        return {"backend": "sqlite", "journaled": journaled, "pending": pending, "claimed": claimed, "leased": leased,
+                "pending_writes": pending_writes, "commits": self.commits, "redelivered": self.redelivered}
+
+    def close(self) -> None:
+        """
+        Commits whatever is still pending and closes the database.
+        """
+        with self._pending_lock:
+            self._closed = True
+            self._pending_lock.notify()
+
+        self._writer.join()
+        self.flush()
+
+        with self._db_lock:
+            self._db.close()
+
+class SQLiteSeenSet:
+    """
+    A time-windowed seen-set kept in a SQLite database, with the add and pop of caches.TTLStore.
+    Every process using the same database shares it, e.g. the webhook processes which must all recognize an update
+    Telegram delivers again, whichever of them got it first.
+
+    Like appending to the queue, adding never waits for the database's write lock: the key is looked up in the keys this
+    process has seen and then in the database (a read, which WAL never blocks), and a new key is committed by a writer thread
+    every flush_interval seconds. A re-delivery reaching another process within flush_interval of the first one isn't caught,
+    which is far shorter than the seconds Telegram waits before retrying an update.
+    """
+    def __init__(self, path, ttl, max_entries=None, flush_interval=0.05, purge_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._purged = 0.0
+        self._shared_hits = 0
+        self.commits = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = self._connect()
+        self._db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+        self._db_lock = threading.Lock()
+        # The keys this process has seen, so a re-delivery to the same process doesn't even read the database
+        self._local = TTLStore(ttl, max_entries)
+
+        self._pending = []
+        self._pending_lock = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_batches, name="SQLiteSeenWriter", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+
+        return db
+
+    @property
+    def hits(self):
+        return self._local.hits + self._shared_hits
+
+    def add(self, key, value=True) -> bool:
+        """
+        Records the key unless it was already recorded (and didn't expire yet).
+
+        :param key: A JSON serializable key
+        :return: True if the key was recorded, False if it was already seen
+        """
+        key = json.dumps(key)
+
+        if not self._local.add(key, value):
+            return False
+
+        now = time.time()
+
+        with self._db_lock:
+            seen = self._db.execute("SELECT 1 FROM seen WHERE key = ? AND expires > ?", (key, now)).fetchone()
+
+        if seen:
+            # Recorded by another process, it stays in the local keys so its next re-delivery is caught right away
+            self._shared_hits += 1
+            return False
+
+        self._add_pending(("add", key, now + self.ttl))
+        return True
+
+    def pop(self, key, default=None):
+        """
+        Forgets the key, so it's no longer seen.
+        """
+        key = json.dumps(key)
+        self._local.pop(key)
+        self._add_pending(("pop", key, None))
+
+        return default
+
+    def _add_pending(self, operation) -> None:
+        with self._pending_lock:
+            self._pending.append(operation)
+
+    def _write_batches(self) -> None:
+        # The writer has a connection of its own, so waiting for the write lock never holds up the lookups
+        db = self._connect()
+
+        while True:
+            with self._pending_lock:
+                if not self._closed:
+                    self._pending_lock.wait(self.flush_interval)
+                closed = self._closed
+
+            try:
+                self._flush(db)
+            except Exception as e:
+                logger.exception(f"Was unable to write to the seen updates of {self.path}.\n{e}")
+                if not closed:
+                    time.sleep(self.flush_interval)
+                    continue
+
+            if closed:
+                db.close()
+                return
+
+    def _flush(self, db) -> None:
+        """
+        Commits all the pending keys in a single transaction, purging the expired ones every purge_interval seconds.
+        """
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+
+        now = time.time()
+        purge = now - self._purged >= self.purge_interval
+
+        if not batch and not purge:
+            return
+
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for operation, key, expires in batch:
+                if operation == "add":
+                    db.execute("INSERT OR REPLACE INTO seen (key, expires) VALUES (?, ?)", (key, expires))
+                else:
+                    db.execute("DELETE FROM seen WHERE key = ?", (key,))
+            if purge:
+                db.execute("DELETE FROM seen WHERE expires <= ?", (now,))
+            db.execute("COMMIT")
+            self.commits += 1
+        except Exception:
+            db.execute("ROLLBACK")
+            # Put the batch back so it's retried with the next one
+            with self._pending_lock:
+                self._pending = batch + self._pending
+            raise
+
+        if purge:
+            self._purged = now
+
+    def close(self) -> None:
+        """
+        Commits the keys still pending and closes the database.
+        """
+        with self._pending_lock:
+            self._closed = True
+            self._pending_lock.notify()
+
+        self._writer.join()
+
+        with self._db_lock:
+            self._db.close()
+
+def get_queue_backend(name="memory", path=None, **kwargs):
+    """
+    Creates the message queue backend by its name, either "memory" (default) or "sqlite".
+
+    :param path: The database file of the sqlite backend
+    :param kwargs: The sqlite backend's batching and visibility timeout arguments
+    """
+    if name == "sqlite":
+        return SQLiteQueueBackend(path or "messages.db", **kwargs)
+    if name == "memory":
+        return MemoryQueueBackend()
+
+    raise ValueError(f"Unknown message queue backend {name}.")
@@ -0,0 +1,169 @@
+"""
+The production entry point of the service.
+
+It runs the webhook on a multi-worker gunicorn server, and the message and result workers in separate processes
+(MESSAGE_PROCESSES and RESULT_PROCESSES of them), all connected by the durable SQLite message queue they share:
+the webhook processes only append the messages to it and every message process claims the messages of its share of the chats,
+so the messages of a chat are handled in order.
+
+Everything is imported once in this process before any of the others is forked, so they all share
+the modules' memory copy-on-write. This process then only restarts the processes which exit.
+"""
+import os
+
+# The processes must share the message queue, so it has to be the durable one
+os.environ.setdefault('MESSAGE_QUEUE_BACKEND', 'sqlite')
+
+from gunicorn.app.base import BaseApplication
+from loguru import logger
+import multiprocessing
+import threading
+import signal
+import flask_app
+# Imported ahead of time so they're shared too, they're otherwise only imported by the image jobs
+import img_proc
+import img_codec
+
+WEB_WORKERS       = int(os.getenv('WEB_WORKERS', '2'))
+WEB_THREADS       = int(os.getenv('WEB_THREADS', '4'))
+WEB_BIND          = os.getenv('WEB_BIND', '0.0.0.0:8443')
+MESSAGE_PROCESSES = int(os.getenv('MESSAGE_PROCESSES', '1'))
+RESULT_PROCESSES  = int(os.getenv('RESULT_PROCESSES', '1'))
+
+class WebhookApplication(BaseApplication):
+    """
+    Runs the Flask app on gunicorn, configured from here rather than from the command line
+    """
+    def __init__(self, application, options=None):
+        self.application = application
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+def post_fork(server, worker):
+    """
+    The queue's writer thread has to be started in every web worker itself, as threads don't survive a fork
+    """
+    flask_app.message_queue = flask_app.create_message_queue(ingress_only=True)
+    # Shared by all the web workers, whichever of them gets an update Telegram delivers again
+    flask_app.seen_updates = flask_app.create_seen_updates()
+
+def worker_exit(server, worker):
+    """
+    Called by gunicorn when a web worker stops gracefully. The messages it appended and the updates it saw lately
+    are committed by the writer threads only every flush interval, so the last ones are committed here.
+    """
+    flask_app.close_queues()
+
+def run_web():
+    # gunicorn installs signal handlers of its own
+    WebhookApplication(flask_app.app, {
+        "bind": WEB_BIND,
+        "workers": WEB_WORKERS,
+        "threads": WEB_THREADS,
+        "preload_app": True,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+    }).run()
+
+def reset_signals():
+    """
+    The forked processes inherit the supervisor's signal handlers, they should just exit on SIGTERM/SIGINT
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+def run_messages(index):
+    stopping = threading.Event()
+    # The acks, leases and media group flushes are committed by the queue's writer thread, so the process commits
+    # what's still pending before it exits. A message still being handled is delivered again on the next run.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    # Only the first message process registers the webhook with Telegram
+    bot_factory = flask_app.BotFactory(flask_app.TELEGRAM_TOKEN, flask_app.TELEGRAM_APP_URL, flask_app.DOMAIN_CERTIFICATE,
+                                       register_webhook=index == 0)
+
+    flask_app.message_queue = flask_app.create_message_queue()
+    # Every message process handles the messages of its own share of the chats
+    flask_app.message_queue.start_feeder(partition=index, partitions=MESSAGE_PROCESSES)
+    flask_app.message_queue.watch_visibility()
+    flask_app.start_message_workers(bot_factory, flask_app.message_queue)
+
+    stopping.wait()
+    flask_app.message_queue.backend.close()
+
+def run_results(index):
+    reset_signals()
+    bot_factory = flask_app.BotFactory(flask_app.TELEGRAM_TOKEN, flask_app.TELEGRAM_APP_URL, flask_app.DOMAIN_CERTIFICATE,
+                                       register_webhook=False)
+    flask_app.start_result_workers(bot_factory)
+
+    threading.Event().wait()
+
+def release_claims(pid):
+    """
+    Makes the messages a message process which exited claimed available to the other processes again
+    """
+    queue_backend = flask_app.create_queue_backend()
+    try:
+        queue_backend.release_claims(pid)
+    except Exception as e:
+        # Released anyway on the next start of the service
+        logger.exception(f"Was unable to release the messages claimed by process {pid}.\n{e}")
+    finally:
+        queue_backend.close()
+
+def main():
+    # Before anything is forked, so every process has the secrets and gunicorn's workers the webhook route
+    flask_app.init_app()
+
+    # No process handles any message yet, so the messages leased by the processes of the previous run can be claimed again right away
+    queue_backend = flask_app.create_queue_backend()
+    queue_backend.release_leases()
+    queue_backend.close()
+
+    context = multiprocessing.get_context("fork")
+    targets = {"web": (run_web, ())}
+    targets.update({f"messages-{index}": (run_messages, (index,)) for index in range(MESSAGE_PROCESSES)})
+    targets.update({f"results-{index}": (run_results, (index,)) for index in range(RESULT_PROCESSES)})
+
+    processes = {}
+    stopping = threading.Event()
+
+    def start(name):
+        target, args = targets[name]
+        processes[name] = context.Process(target=target, args=args, name=name)
+        processes[name].start()
+        logger.info(f"Started the {name} process (pid {processes[name].pid})")
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for name in targets:
+        start(name)
+
+    while not stopping.wait(1):
+        for name, process in processes.items():
+            if not process.is_alive():
+                logger.error(f"The {name} process exited with code {process.exitcode}, restarting it")
+                if name.startswith("messages-"):
+                    release_claims(process.pid)
+                start(name)
+
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+
+if __name__ == "__main__":
+    main()